@@ -0,0 +1,56 @@
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules imported by the different entry points
+entry_modules = dict(
+    server="project.src.server_machinery",
+    inspect="project.server_inspect",
+    reset="project.server_reset",
+)
+
+# Number of cold starts per entry point
+n_runs = 5
+
+# Number of slowest modules to show
+n_slowest = 10
+
+
+def import_times(module):
+    """
+    Cold-start import of module in a fresh interpreter using "python -X importtime".
+    Returns dictionary of cumulative import time (in seconds) for each imported module.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=str(Path(__file__).parent.parent), capture_output=True, text=True, check=True,
+    )
+
+    # Parse lines like: "import time:       123 |       4567 |   numpy"
+    times = dict()
+    for line in result.stderr.splitlines():
+        search = re.search("^import time:\\s*(\\d+)\\s*\\|\\s*(\\d+)\\s*\\|(\\s*)(\\S+)", line)
+        if search:
+            times[search.group(4)] = int(search.group(2)) * 1e-6
+    return times
+
+
+if __name__ == "__main__":
+
+    for name, module in entry_modules.items():
+        # Run cold starts
+        runs = [import_times(module=module) for _ in range(n_runs)]
+        totals = sorted(run[module] for run in runs)
+
+        # Report
+        print("-" * 100)
+        print(f"{name} ({module}): median {totals[len(totals) // 2] * 1000:.1f}ms, "
+              f"min {totals[0] * 1000:.1f}ms, max {totals[-1] * 1000:.1f}ms")
+
+        # Slowest top-level packages of last run
+        top_level = {key: val for key, val in runs[-1].items() if "." not in key and key != module}
+        for key, val in sorted(top_level.items(), key=lambda item: -item[1])[:n_slowest]:
+            print(f"\t{key:30s} {val * 1000:8.1f}ms")
+
+    print("-" * 100)
@@ -1,6 +1,7 @@
 import numpy as np
 
 from project.src.causal_system import CausalSystem
+from project.src.system_registry import SystemRegistry
 
 
 class ServerSettings:
@@ -13,9 +14,50 @@ class ServerSettings:
     imap_host = "imap.gmail.com"  # <*\label{code:imap_host}*>
     smtp_host = "smtp.gmail.com"  # <*\label{code:smtp_host}*>
     smtp_port = 587  # <*\label{code:smtp_port}*>
+    imap_port = None  # Default port of imap_ssl
+    imap_ssl = True
+    smtp_starttls = True
 
     # Other settings
     check_email_delay = 2  # <*\label{code:server_check_time}*>
+    imap_fetch_chunk = 200  # Number of emails fetched or flagged per IMAP command
+    handled_email_action = "flag"  # Mark handled emails: "flag", "move" (to handled_email_folder) or None
+    handled_email_keyword = "$Handled"  # Keyword of flagged emails (the seen-flag is also set by opening in webmail)
+    handled_email_folder = "handled"
+    handled_ids_journal = 1000  # Handled emails stored in a journal before the snapshot of handled ids is rewritten
+
+    # Sending replies (queued by priority and paced to the sending limits of the email provider)
+    smtp_rate = 1  # Emails sent per second on average (None for no limit)
+    smtp_burst = 20  # Emails that can be sent at once
+    smtp_retry_seconds = 60  # Seconds before an email that could not be sent is tried again
+    smtp_max_attempts = 3  # Times an email is tried before it is given up
+    error_coalesce_seconds = 60  # Error-replies to a student within this time are sent as one email (None for never)
+
+    # Writing data-files
+    render_workers = 4  # Threads writing data-files (shared by all emails)
+    render_chunk_rows = 10000  # Rows written to the data-file at a time
+
+    # Asyncio server (server_run.py --asyncio)
+    idle_timeout = 300  # Seconds to wait for new emails with IMAP IDLE before checking again
+    async_max_workers = 8  # Threads for sampling, writing data-files and sending emails
+    async_max_in_flight = 32  # Emails handled at the same time
+    reply_with_rank = True  # Tell students their leaderboard rank when they guess the graph
+    guess_feedback = None  # Details in replies to incorrect guesses: None, "shd" (distance) or "edges" (differences)
+
+    # Reservoirs of pre-sampled rows for common settings, refilled while waiting for emails (empty list to disable)
+    #   Settings are written as in subject lines without the number of samples, eg. "" (no interventions), "X=1" or
+    #   "[name] X=1" (for another system)
+    reservoir_settings = []
+    reservoir_rows = 50000  # Rows kept for each settings
+    reservoir_chunk_rows = 10000  # Rows sampled at a time
+    reservoir_max_bytes = 200e6  # Memory used by all reservoirs
+    reservoir_refill_seconds = 1  # Time spent refilling in each check for emails
+
+    # Retention of student data-files (None means no limit)
+    data_max_requests_per_user = None
+    data_max_bytes_per_user = None
+    data_max_age_days = None
+    data_cleanup_interval = 600
 
     # Emails with access to experiment   # <*\label{code:allowed_emails_start}*>
     allowed_emails = """
@@ -25,6 +67,9 @@ class ServerSettings:
     student_email_2@university.com
     """  # <*\label{code:allowed_emails_stop}*>
 
+    # File with more emails with access (one per line or SQLite with table "allowed_emails"), reloaded when changed
+    allowed_emails_file = None
+
 
 # Define the causal system
 class ExperimentSystem(CausalSystem):  # <*\label{code:ExperimentSystem}*>
@@ -35,6 +80,9 @@ class ExperimentSystem(CausalSystem):  # <*\label{code:ExperimentSystem}*>
     sample_cost = 1
     incorrect_guess_cost = 70
 
+    # Each pre-made distribution below is used only by the node it is drawn for, so cols-queries can skip the others
+    partial_sampling = True
+
     # Causal model
     def _sample(self, n_samples):  # <*\label{code:_sample}*>
         # Using predefined distributions
@@ -58,3 +106,13 @@ class ExperimentSystem(CausalSystem):  # <*\label{code:ExperimentSystem}*>
 
         # Ordering without hint of causal structure
         self._ordering = ['I', 'Z', 'F', '_H', 'X', 'G', 'Y']  # <*\label{code:ordering}*>
+
+
+# Causal systems served by the server
+#   Emails are routed to a system with a subject prefix like "[name] 20, X=1" or by the sender being in the
+#   group of the system. All other emails use the "default" system.
+server_systems = SystemRegistry()
+server_systems.register("default", ExperimentSystem)
+# server_systems.register("group_2", OtherExperimentSystem, senders="""
+# student_email_2@university.com
+# """)
@@ -0,0 +1,31 @@
+import argparse
+
+from project.define_server import server_systems
+from project.src.server_util import pandas_print
+from project.src.system_registry import default_system
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the structural equations of a causal system.")
+    parser.add_argument("--system", type=str, default=default_system, choices=list(server_systems),
+                        help="Causal system to profile.")
+    parser.add_argument("--samples", type=int, default=100000, help="Number of samples per call.")
+    parser.add_argument("--calls", type=int, default=20, help="Number of calls of sample().")
+    parser.add_argument("--memory", action="store_true", help="Also trace memory allocated by each node (slower).")
+    parser.add_argument("--flamegraph", type=str, default=None,
+                        help="Write collapsed stacks to this file (for flamegraph.pl, speedscope etc.).")
+    args = parser.parse_args()
+
+    # Sample while profiling
+    system = server_systems[args.system]()
+    profiler = system.start_profiling(memory=args.memory)
+    for _ in range(args.calls):
+        _ = system.sample(args.samples)
+    system.stop_profiling()
+
+    # Report
+    print(f"{args.calls} calls of sample({args.samples}) on {type(system).__name__}")
+    with pandas_print():
+        print(profiler.table())
+    if args.flamegraph is not None:
+        profiler.write_flamegraph(args.flamegraph, root=type(system).__name__)
+        print(f"Wrote {args.flamegraph}")
@@ -0,0 +1,18 @@
+import argparse
+from datetime import datetime, timedelta
+
+from project.src.sample_store import SampleStore
+from project.src.server_util import Storage
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete old samples from the sample store.")
+    parser.add_argument("--days", type=float, default=120,
+                        help="Keep samples from the last DAYS days (default 120).")
+    args = parser.parse_args()
+
+    # Compact store
+    older_than = datetime.now() - timedelta(days=args.days)
+    with SampleStore(Storage.samples_path) as store:
+        n_files, n_bytes = store.compact(older_than=older_than)
+
+    print(f"Deleted {n_files} files ({n_bytes / 1e6:.1f}MB) from before {older_than:%Y-%m-%d %H:%M}.")
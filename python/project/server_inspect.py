@@ -1,54 +1,32 @@
+import argparse
 import shelve
 import textwrap
+from datetime import datetime
+from time import sleep
 
-import numpy as np
 import pandas as pd
 
-from project.define_server import ExperimentSystem
+from project.define_server import server_systems
+from project.src.handled_emails import EmailLog
+from project.src.server_stats import StatsDatabase
 from project.src.server_util import pandas_print, Storage
+from project.src.system_registry import ServedSystem, default_system
 
-if __name__ == "__main__":
-
-    # Connect to shelf and get ids of previously handled emails
-    with shelve.open(str(Storage.shelf_path)) as db:
-
-        # Get info
-        try:
-            prev_ids = db["ids"]  # type: set
-            users = db["users"]  # type: dict
-            success_ids = db["success_ids"]  # type: set
-        except KeyError:
-            print("Shelf is empty")
-            quit()
 
+def print_tables(stats, system_class, since=None, until=None, user=None):
     # Header
+    n_emails, n_success = stats.n_emails(since=since, until=until)
     print("\n")
     print(textwrap.dedent(f"""
     Server results. \n
-    {len(prev_ids)} emails reveived.
-    {len(success_ids)} where successfully parsed ({len(success_ids) / len(prev_ids):.1%}).
+    {n_emails} emails reveived.
+    {n_success} where successfully parsed ({n_success / max(n_emails, 1):.1%}).
     """).strip())
 
-    # Extract users data
-    names, raw_data = zip(*users.items())
-
     ##################################################
     # Server table
 
-    # Data
-    columns = ["n_emails", "n_samples", "n_experiments", "guesses", "incorrect_guesses"]
-    data = np.array([tuple(val.get(k, np.nan) for k in columns) for val in raw_data])
-
-    # Bad emails
-    bad = data[:, 0] - data[:, 2] - data[:, 3]
-    data = np.concatenate((data, bad[:, None]), axis=1)
-    columns.append("bad_emails")
-
-    # Table
-    table = pd.DataFrame(
-        data=data,
-        index=names, columns=columns
-    )
+    table = stats.user_table(since=since, until=until, user=user)
 
     # Users
     print("\n")
@@ -61,40 +39,38 @@ if __name__ == "__main__":
     ##################################################
     # Competition
 
-    # Data
-    columns = ["n_experiments", "n_samples", "incorrect_guesses"]
-    data = np.array([val.get("done", (np.nan,) * 3) for val in raw_data])
-
-    # Compute score
-    scores = (
-            data[:, 0] * ExperimentSystem.experiment_cost
-            + data[:, 1] * ExperimentSystem.sample_cost
-            + data[:, 2] * ExperimentSystem.incorrect_guess_cost
+    table = stats.competition_table(
+        experiment_cost=system_class.experiment_cost,
+        sample_cost=system_class.sample_cost,
+        incorrect_guess_cost=system_class.incorrect_guess_cost,
+        since=since, until=until, user=user,
     )
 
-    # Append score
-    data = np.concatenate((data, scores[:, None]), axis=1)
-    columns.append("cost")
+    # Users
+    print("\n")
+    print("-" * 100)
+    print("Competition table")
+    with pandas_print():
+        print(table)
+
+    ##################################################
+    # Guesses
 
-    # Make table of users
-    table = pd.DataFrame(
-        data=data,
-        index=names, columns=columns
-    )
+    table = stats.guess_table(since=since, until=until, user=user)
 
     # Users
     print("\n")
     print("-" * 100)
-    print("Competition table")
+    print("Graph-guesses (structural Hamming distance to true graph)")
     with pandas_print():
-        print(table.sort_values("cost"))
+        print(table)
 
     #####################################################
     # Costs
 
     # Costs
     table = pd.DataFrame(
-        data=[[ExperimentSystem.experiment_cost, ExperimentSystem.sample_cost, ExperimentSystem.incorrect_guess_cost]],
+        data=[[system_class.experiment_cost, system_class.sample_cost, system_class.incorrect_guess_cost]],
         columns=["experiment_cost", "sample_cose", "incorrect_guess_cost"],
         index=["Costs"]
 
@@ -107,3 +83,48 @@ if __name__ == "__main__":
         print(table)
     print("-" * 100)
     print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect statistics of server.")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None,
+                        help="Only include emails from this time (eg. 2020-06-01 or '2020-06-01 12:00').")
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None,
+                        help="Only include emails before this time.")
+    parser.add_argument("--user", type=str, default=None,
+                        help="Only include this user.")
+    parser.add_argument("--system", type=str, default=default_system, choices=list(server_systems),
+                        help="Causal system to inspect.")
+    parser.add_argument("--watch", type=float, nargs="?", const=5., default=None,
+                        help="Keep refreshing the tables every WATCH seconds (default 5).")
+    args = parser.parse_args()
+
+    system_class = server_systems[args.system]
+    with StatsDatabase(ServedSystem.stats_path(name=args.system)) as stats:
+
+        # Fill database from shelf if server was run before the database existed
+        if stats.is_empty:
+            with shelve.open(str(Storage.shelf_path)) as db:
+                users_key = ServedSystem.users_key(name=args.system)
+                if users_key not in db:
+                    print("Shelf is empty")
+                    quit()
+                emails = dict()
+                if args.system == default_system:
+                    emails = db.get("emails", None)  # Shelves of older servers
+                    if emails is None:
+                        with EmailLog(Storage.email_log_path) as email_log:
+                            emails = email_log.to_dict()
+                stats.import_shelf(emails=emails, users=db[users_key])
+
+        # Print once
+        if args.watch is None:
+            print_tables(stats=stats, system_class=system_class, since=args.since, until=args.until, user=args.user)
+
+        # Keep printing
+        else:
+            while True:
+                print("\033[2J\033[H", end="")
+                print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                print_tables(stats=stats, system_class=system_class, since=args.since, until=args.until, user=args.user)
+                sleep(args.watch)
@@ -0,0 +1,169 @@
+import argparse
+import contextlib
+import io
+import random
+import resource
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+
+from project.define_server import ServerSettings
+from project.src.mail_stand_ins import MailStandIns
+from project.src.server_util import Storage
+
+
+def synthetic_subjects(n_emails, fraction_guesses, fraction_malformed, max_samples, seed=None):
+    """
+    Mix of experiment queries, graph-guesses and malformed subject lines.
+    """
+    rng = random.Random(seed)
+    subjects = []
+    for _ in range(n_emails):
+        draw = rng.random()
+        if draw < fraction_malformed:
+            subjects.append(rng.choice(["hello", "X=1", "guess: A -> B", "", "samples please"]))
+        elif draw < fraction_malformed + fraction_guesses:
+            subjects.append("guess: [('X', 'G'), ('F', 'G'), ('F', 'I')]")
+        else:
+            settings = rng.choice(["", ", X=1", ", X=2, Y=0", ", F=0.5"])
+            subjects.append(f"{rng.randint(1, max_samples)}{settings}")
+    return subjects
+
+
+def percentiles(values):
+    if not values:
+        return dict()
+    result = {f"p{val}": float(np.percentile(values, val)) for val in (50, 90, 99)}
+    result["max"] = float(max(values))
+    return result
+
+
+def run_load_test(n_students=20, n_emails=200, fraction_guesses=0.1, fraction_malformed=0.1, max_samples=1000,
+                  use_asyncio=False, arrival_rate=None, timeout=600, seed=None):
+    """
+    Runs the server against local IMAP/SMTP stand-ins with synthetic student traffic and returns metrics.
+    Storage is redirected to a temporary directory, so the real storage of the server is not touched.
+    Emails arrive all at once, or as a Poisson process with arrival_rate emails per second.
+    """
+    students = [f"student_{nr}@university.com" for nr in range(n_students)]
+    rng = random.Random(seed)
+    traffic = [
+        (rng.choice(students), subject)
+        for subject in synthetic_subjects(
+            n_emails=n_emails, fraction_guesses=fraction_guesses, fraction_malformed=fraction_malformed,
+            max_samples=max_samples, seed=seed,
+        )
+    ]
+
+    # Server settings pointing at the stand-ins (restored afterwards)
+    settings = dict(
+        imap_host="127.0.0.1", imap_ssl=False, smtp_host="127.0.0.1", smtp_starttls=False,
+        username="server@localhost", server_password="stand-in", allowed_emails="\n".join(students),
+        allowed_emails_file=None, handled_email_action="flag", check_email_delay=0.1, idle_timeout=1,
+        smtp_rate=None, error_coalesce_seconds=None,  # Every email gets its own reply, without pacing
+    )
+    original_settings = {key: getattr(ServerSettings, key) for key in list(settings) + ["imap_port", "smtp_port"]}
+    original_main = Storage.main
+
+    with tempfile.TemporaryDirectory() as directory, MailStandIns() as stand_ins:
+        mailbox = stand_ins.mailbox
+        for key, val in settings.items():
+            setattr(ServerSettings, key, val)
+        ServerSettings.imap_port = stand_ins.imap_port
+        ServerSettings.smtp_port = stand_ins.smtp_port
+        Storage.use(Path(directory, "storage"))
+
+        try:
+            # Server (imported here, as it reads the settings)
+            if use_asyncio:
+                from project.src.async_server import AsyncServer
+                server = AsyncServer()
+            else:
+                from project.src.server_machinery import Server
+                server = Server()
+
+            # Deliver emails
+            def deliver():
+                for sender, subject in traffic:
+                    mailbox.deliver(sender=sender, subject=subject)
+                    if arrival_rate:
+                        sleep(rng.expovariate(arrival_rate))
+            delivery = threading.Thread(target=deliver, daemon=True)
+
+            # Run server until all emails are answered (its output is discarded)
+            start = perf_counter()
+            delivery.start()
+            log = io.StringIO()
+            while mailbox.n_sent() < len(traffic) and perf_counter() - start < timeout:
+                with contextlib.redirect_stdout(log):
+                    server(single_run=True)
+                if not mailbox.uids(criteria="NOT DELETED UNKEYWORD $Handled"):
+                    sleep(0.01)
+            duration = perf_counter() - start
+            delivery.join()
+        finally:
+            for key, val in original_settings.items():
+                setattr(ServerSettings, key, val)
+            Storage.use(original_main)
+
+    # Latencies (replies name the uids of the emails they answer, as replies are sent by priority and not in order)
+    latencies = [
+        sent["received"] - mailbox.inbox[uid]["delivered"]
+        for sent in mailbox.sent
+        for uid in sent["reply_to_ids"]
+        if uid in mailbox.inbox
+    ]
+
+    # Peak memory (kilobytes on Linux, bytes on macOS)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1e6 if sys.platform == "darwin" else peak_rss / 1e3
+
+    return dict(
+        n_emails=len(traffic),
+        n_replies=len(mailbox.sent),
+        reply_megabytes=sum(val["n_bytes"] for val in mailbox.sent) / 1e6,
+        seconds=duration,
+        emails_per_second=len(mailbox.sent) / duration if duration > 0 else float("nan"),
+        latency_seconds=percentiles(latencies),
+        peak_rss_mb=peak_rss_mb,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load-test server with local IMAP/SMTP stand-ins and synthetic student traffic."
+    )
+    parser.add_argument("--students", type=int, default=20, help="Number of simulated students.")
+    parser.add_argument("--emails", type=int, default=200, help="Number of emails sent by the students.")
+    parser.add_argument("--guesses", type=float, default=0.1, help="Fraction of emails that are graph-guesses.")
+    parser.add_argument("--malformed", type=float, default=0.1, help="Fraction of emails that are malformed.")
+    parser.add_argument("--max-samples", type=int, default=1000, help="Largest number of samples requested.")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Emails per second (Poisson arrivals). All emails arrive at once if not given.")
+    parser.add_argument("--asyncio", action="store_true", help="Load-test the asyncio server.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds before the test is stopped.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    metrics = run_load_test(
+        n_students=args.students,
+        n_emails=args.emails,
+        fraction_guesses=args.guesses,
+        fraction_malformed=args.malformed,
+        max_samples=args.max_samples,
+        use_asyncio=args.asyncio,
+        arrival_rate=args.rate,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+
+    print(f"Server:      {'asyncio' if args.asyncio else 'synchronous'}")
+    print(f"Emails:      {metrics['n_emails']} from {args.students} students, {metrics['n_replies']} replies "
+          f"({metrics['reply_megabytes']:.1f}MB)")
+    print(f"Duration:    {metrics['seconds']:.2f}s ({metrics['emails_per_second']:.1f} emails/s)")
+    print("Latency:     " + ", ".join(f"{key} {val:.3f}s" for key, val in metrics["latency_seconds"].items()))
+    print(f"Peak memory: {metrics['peak_rss_mb']:.0f}MB")
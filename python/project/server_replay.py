@@ -0,0 +1,30 @@
+import argparse
+from time import perf_counter
+
+from project.define_server import ServerSettings
+from project.src.allow_list import AllowList
+from project.src.replay import mbox_log, replay, store_log
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the server's statistics from archived emails, without sampling or connecting to email."
+    )
+    parser.add_argument("--mbox", type=str, default=None,
+                        help="Archive of the inbox in mbox-format. Uses the server's persistent memory if not given.")
+    args = parser.parse_args()
+
+    start = perf_counter()
+
+    # Emails from archive (only from allowed senders) or from persistent memory (all were handled by the server)
+    if args.mbox is not None:
+        log = mbox_log(args.mbox)
+        allowed_emails = AllowList(emails=ServerSettings.allowed_emails, path=ServerSettings.allowed_emails_file)
+    else:
+        log = store_log()
+        allowed_emails = None
+
+    # Rebuild
+    emails = replay(log=log, allowed_emails=allowed_emails)
+
+    print(f"Replayed {len(emails)} emails ({int(emails['success'].sum())} successful) "
+          f"of {emails['sender'].nunique()} users in {perf_counter() - start:.2f}s.")
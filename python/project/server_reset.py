@@ -1,16 +1,24 @@
 import shutil
 from project.src.server_util import Storage
+from project.src.student_data import move_to_trash
 
 
-def reset_server(complete=True):
+def reset_server(complete=True, background=True):
+    """
+    With background the student data is only moved to the trash (a fast rename), which the janitor of the server
+    empties, so resetting does not wait for the data to be deleted.
+    """
     if Storage.shelf_path.parent.exists():
         for path in Storage.shelf_path.parent.glob("*"):
             path.unlink()
 
     if complete:
-        if Storage.data_path.exists():
-            for path in Storage.data_path.glob("*"):
-                shutil.rmtree(path)
+        for path in (Storage.data_path, Storage.samples_path):
+            if path.exists():
+                if background:
+                    move_to_trash(path)
+                else:
+                    shutil.rmtree(path)
 
     # Remake structure
     Storage.data_path.mkdir(parents=True, exist_ok=True)
@@ -1,8 +1,19 @@
+import argparse
+
 from project.src.server_machinery import Server
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run server.")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="Run asyncio server (waits for emails with IMAP IDLE and sends replies concurrently).")
+    args = parser.parse_args()
+
     # Make server
-    server = Server()
+    if args.asyncio:
+        from project.src.async_server import AsyncServer
+        server = AsyncServer()
+    else:
+        server = Server()
 
     # Run
     server()
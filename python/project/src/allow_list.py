@@ -0,0 +1,83 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+
+def normalize_email(email):
+    """
+    Case-folds email and removes plus-addressing (name+tag@host -> name@host).
+    """
+    email = email.strip().casefold()
+    local, at, host = email.rpartition("@")
+    if not at:
+        return email
+    return local.split("+", 1)[0] + "@" + host
+
+
+def parse_emails(text):
+    # One email per line, "#" starts a comment
+    emails = (line.split("#", 1)[0].strip() for line in text.split("\n"))
+    return {normalize_email(val) for val in emails if val}
+
+
+class AllowList:
+    """
+    Set of normalized emails with access to the server.
+    Emails come from a string (like ServerSettings.allowed_emails) and optionally a file, which is reloaded when it
+    changes. The file is either a text-file with one email per line or a SQLite database (.sqlite or .db) with a
+    table "allowed_emails" with a column "email". If the file can not be loaded, the error is reported with
+    report(text) and the previously loaded emails are kept.
+    """
+    def __init__(self, emails="", path=None, report=print):
+        self._inline_emails = parse_emails(emails)
+        self.report = report
+        self.path = None if path is None else Path(path)
+        self._file_emails = set()
+        self._file_mtime = None
+        self.emails = frozenset(self._inline_emails)
+        self.refresh()
+
+    def __contains__(self, email):
+        return normalize_email(email) in self.emails
+
+    def __len__(self):
+        return len(self.emails)
+
+    def __iter__(self):
+        return iter(self.emails)
+
+    def refresh(self):
+        """
+        Reloads file if it has changed. Returns True if reloaded.
+        """
+        if self.path is None:
+            return False
+
+        # Check for changes
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._file_mtime:
+            return False
+        self._file_mtime = mtime
+
+        # Load (a connection used as context manager only ends the transaction, so it is closed explicitly)
+        try:
+            if mtime is None:
+                file_emails = set()
+            elif self.path.suffix in (".sqlite", ".db"):
+                with closing(sqlite3.connect(str(self.path))) as connection:
+                    file_emails = {normalize_email(str(val)) for val, in connection.execute(
+                        "SELECT email FROM allowed_emails"
+                    ) if val}
+            else:
+                file_emails = parse_emails(self.path.read_text())
+        except (OSError, UnicodeDecodeError, sqlite3.Error) as error:
+            self.report(f"Could not load allowed emails from {self.path}, keeping previous emails: {error!r}")
+            return False
+        self._file_emails = file_emails
+
+        # Swap in new set (lookups never see a partially loaded set)
+        self.emails = frozenset(self._inline_emails | self._file_emails)
+        return True
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from imapclient import exceptions
+
+from project.define_server import ServerSettings
+from project.src.server_machinery import Server
+
+
+class AsyncServer(Server):
+    """
+    Server running on asyncio.
+    New emails are awaited with IMAP IDLE, while sampling, writing data-files and sending emails run on a thread pool,
+    so replies to different students overlap their network waits. Emails from the same student are handled in order,
+    and each email is handled with the steps of Server.handle_allowed_email (see EmailJob).
+    Queued replies are sent by a background task, which sends all replies that are due at the same time.
+    """
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=ServerSettings.async_max_workers)
+        self._system_locks = dict()
+        self._reply_queued = None
+        self._stop_replies = False
+
+    async def run_blocking(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def queue_reply(self, *args, **kwargs):
+        super().queue_reply(*args, **kwargs)
+        if self._reply_queued is not None:
+            self._reply_queued.set()
+
+    async def send_replies(self):
+        """
+        Keeps sending queued replies as they become due, until _stop_replies is set (replies being sent are finished).
+        """
+        while not self._stop_replies:
+            emails = []
+            email = self.outbox.pop_due()
+            while email is not None:
+                emails.append(email)
+                email = self.outbox.pop_due()
+            await asyncio.gather(*[self.run_blocking(self.outbox.send_email, val) for val in emails])
+
+            # Wait until next reply is due or a reply is queued
+            if self._stop_replies:
+                break
+            self._reply_queued.clear()
+            try:
+                await asyncio.wait_for(self._reply_queued.wait(), timeout=self.outbox.seconds_to_next())
+            except asyncio.TimeoutError:
+                pass
+
+    def wait_for_emails(self, timeout):
+        """
+        Blocks until the inbox changes (IMAP IDLE) or timeout seconds have passed.
+        Falls back to sleeping ServerSettings.check_email_delay if the email provider does not support IDLE.
+        """
+        try:
+            client = self.imap_inbox()
+
+            # Return right away if emails arrived since last check
+            if any(val not in self.prev_ids for val in client.search(self.search_criteria())):
+                return
+
+            # Wait for changes
+            if client.has_capability("IDLE"):
+                client.idle()
+                try:
+                    client.idle_check(timeout=timeout)
+                finally:
+                    client.idle_done()
+                return
+        except (exceptions.IMAPClientError, OSError):
+            self.close_imap()
+        sleep(ServerSettings.check_email_delay)
+
+    async def handle_allowed_email_async(self, subject: str, sender: str, message_id):
+        job = self.start_email(subject=subject, sender=sender, message_id=message_id)
+        system_lock = self._system_locks[job.system_name]
+
+        # Catch most errors due to bad email
+        try:
+            # Guess of causal graph
+            if job.is_guess:
+                async with system_lock:
+                    self.check_guess_email(job)
+
+            # User wants samples
+            else:
+                n_samples, settings = self.parse_query(job)
+                job.samples = self.ready_samples(job, n_samples=n_samples, settings=settings)
+                if job.samples is None:
+                    async with system_lock:
+                        job.samples = await self.run_blocking(job.system.causal_system.sample, n_samples, **settings)
+
+                # Send response
+                if self.answers(job):
+                    await self.run_blocking(self.store_samples, job)
+                    await self.run_blocking(self.render_samples, job)
+                    self.queue_data_reply(job)
+
+                # This was an experiment
+                job.ran_experiment = True
+
+            self.email_succeeded(job)
+
+        # Bad email
+        except (ValueError, AttributeError):
+            self.email_failed(job)
+
+        return self.finish_email(job)
+
+    async def _handle_sender(self, sender, emails, in_flight):
+        # Emails of one sender are handled in order (scores depend on the order)
+        for message_id, subject in emails:
+            async with in_flight:
+                await self.handle_allowed_email_async(subject=subject, sender=sender, message_id=message_id)
+
+    async def run(self, answer_emails=True, single_run=False):
+        self.answer_emails = answer_emails
+        in_flight = asyncio.Semaphore(ServerSettings.async_max_in_flight)
+
+        # Causal systems are not thread-safe, so each is sampled by one task at a time
+        #   (made for each run, as asyncio locks belong to the event loop they are used in)
+        self._system_locks = {name: asyncio.Lock() for name in self.systems}
+
+        # Send queued replies in the background
+        self._reply_queued = asyncio.Event()
+        self._stop_replies = False
+        replies = asyncio.create_task(self.send_replies())
+
+        # Start deleting old student data
+        if not single_run and not self.janitor.is_alive():
+            self.janitor.start()
+
+        # Finish emails from before a restart
+        self.resume_jobs()
+
+        # Keep reading emails
+        while True:
+            print("")
+
+            # Reload allowed emails if file has changed
+            if self.allowed_emails.refresh():
+                self.print(f"\t\tReloaded allowed emails ({len(self.allowed_emails)} emails).")
+
+            # Get emails
+            response, messages = await self.run_blocking(self.get_emails)
+
+            # Didn't success in connecting to email
+            if response is None:
+                self.print("\t\tCan not connect to email provider!")
+
+            # No new emails
+            elif not messages:
+                self.print("\t\tNo new emails.")
+
+            else:
+
+                # Group messages by sender
+                sender_emails = defaultdict(list)
+                for message_id, (subject, sender) in response.items():
+
+                    # Check sender
+                    if sender in self.allowed_emails:
+                        sender_emails[sender].append((message_id, subject))
+
+                    else:
+                        error_message = "Email address not allowed access."
+                        self.print(f"\t\tEmail {message_id}: {error_message} {'[-]':50s}<--")
+
+                # Handle senders concurrently
+                await asyncio.gather(*[
+                    self._handle_sender(sender=sender, emails=emails, in_flight=in_flight)
+                    for sender, emails in sender_emails.items()
+                ])
+
+                # Mark handled emails on server (emails of senders without access are checked again)
+                if self.answer_emails:
+                    handled = [val for val in response if val in self.prev_ids]
+                    await self.run_blocking(self.mark_handled_emails, messages=handled)
+
+            #########################################
+
+            # Wait for new emails (refilling sample reservoir first, while no emails are being handled)
+            if len(self.outbox):
+                self.print(f"\t\t{len(self.outbox)} replies queued")
+            if single_run:
+                self._stop_replies = True
+                self._reply_queued.set()
+                await replies
+                await self.run_blocking(self.outbox.flush)
+                break
+            await self.run_blocking(self.refill_reservoir, seconds=ServerSettings.reservoir_refill_seconds)
+            self.print("Waiting for emails")
+            await self.run_blocking(self.wait_for_emails, timeout=ServerSettings.idle_timeout)
+
+    def __call__(self, answer_emails=True, single_run=False):
+        asyncio.run(self.run(answer_emails=answer_emails, single_run=single_run))
@@ -1,15 +1,54 @@
 from ast import literal_eval
+from io import BytesIO
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import networkx as nx
-import matplotlib.pyplot as plt
-from networkx.drawing.nx_pydot import graphviz_layout
+
+from project.src.graph_layout import graph_cache_path, graph_hash, cached_layout, layout_cache_path
+from project.src.linear_moments import LinearTerm, NonLinearSystemError, linear_moments
+from project.src.sampling_profiler import SamplingProfiler
+
+
+class _StructureChanged(Exception):
+    # Nodes were set in another order than in the previous sample (so the needed nodes are not known), or a needed
+    #   node was drawn with too few samples
+    pass
+
+
+def _whole_numbers(value, chunk_size=65536):
+    # Whether all values are whole numbers (checked in chunks, so most continuous nodes are rejected right away)
+    if np.issubdtype(value.dtype, np.integer) or value.dtype == bool:
+        return True
+    if not np.issubdtype(value.dtype, np.floating):
+        return False
+    value = value.reshape(-1)
+    return all(np.array_equal(value[start:start + chunk_size], np.trunc(value[start:start + chunk_size]))
+               for start in range(0, value.shape[0], chunk_size))
 
 
 class CausalSystem:
     _project_password = None
 
+    # Score settings for competition
+    experiment_cost = 0
+    sample_cost = 0
+    incorrect_guess_cost = 0
+
+    # Types of sampled data
+    #   Nodes with whole-number values (like categorical and binary nodes) are returned in the smallest integer type
+    #   that fits (eg. int8), unless typed_integers is False. Structural equations always see floats.
+    #   Use np.float32 as float_dtype to halve the size of continuous nodes.
+    typed_integers = True
+    float_dtype = np.float64
+
+    # Sample only the requested columns of cols-queries and their ancestors in full (see sample()). Only for systems
+    #   where each pre-made distribution is used by the node set right after drawing it (not shared by several nodes).
+    partial_sampling = False
+
+    # Memory of buffers kept by the pre-made distributions, so the next sample of the same size can reuse them
+    buffer_max_bytes = 64e6
+
     def _sample(self, n_samples):
         raise NotImplementedError
 
@@ -22,57 +61,232 @@ class CausalSystem:
         self._samples = None  # type: dict
         self._n_samples = None  # type: int
 
+        # For exact moments of linear systems
+        self._symbolic = False
+        self._noise_variances = None  # type: list
+
+        # Random generator of pre-made distributions and their buffers (see seed() and _buffer())
+        self.rng = np.random.default_rng()
+        self._buffers = dict()
+        self._n_buffers = 0
+
+        # Arrays made in the current sample (drawn or copied when set) and arrays moved to its table
+        self._fresh = []
+        self._moved = []
+
+        # Statistics of structural equations (only when profiling)
+        self._profiler = None  # type: SamplingProfiler
+
         # Ordering
         self.__ordering = None  # type: list
         self._node_nr = dict()
 
+        # Order nodes are set in (of the previous sample) and the nodes sampled in full (None for all)
+        self._set_order = None  # type: list
+        self._previous_set_order = None  # type: list
+        self._required = None  # type: set
+        self._sample_all = False
+
         # For graph
         self._create_graph = False
         self._current_ancestors = []
         self._ancestors = dict()
         self._descendants = dict()
+        self._true_edges_cache = None
 
         # Always ensure a single sample
         _ = self.sample(1)
 
-    def sample(self, n_samples, **interventions):
+    def sample(self, n_samples, cols=None, **interventions):
+        """
+        Samples table of nodes under interventions.
+        cols is a list of nodes to return (default is all nodes that are not hidden). If the system has
+        partial_sampling, only these nodes and their ancestors are sampled in full and the pre-made distributions of
+        other nodes draw a single sample.
+        """
+        # Nodes in table and nodes needed to make them
+        password = self._project_password is not None and interventions.get("password", None) == self._project_password
+        if cols is not None:
+            try:
+                cols = [cols] if isinstance(cols, str) else list(cols)
+            except TypeError:
+                raise ValueError(f"cols must be a node or a list of nodes, not {cols!r}") from None
+            invalid = [key for key in cols if not isinstance(key, str)]
+            if invalid:
+                raise ValueError(f"Invalid columns: {', '.join(map(repr, invalid))}")
+        index = None if cols is None else set(cols)
+        self._required = self._required_nodes(index=index, interventions=interventions)
+
         # Set
         self._interventions = interventions
         self._samples = dict()
         self.__ordering = []
         self._node_nr = dict()
         self._n_samples = n_samples
+        self._previous_set_order, self._set_order = self._set_order, []
+        self._n_buffers = 0
+        self._fresh = []
+        self._moved = []
 
         # Compute
+        if self._profiler is not None:
+            self._profiler.start_sample()
         self._create_graph = True
-        self._sample(n_samples=n_samples)
+        try:
+            self._sample(n_samples=n_samples)
+        except _StructureChanged:
+            # Sample everything (new order of nodes is recorded)
+            self._create_graph = False
+            self._current_ancestors = []
+            self._set_order = None
+            return self.sample(n_samples, cols=cols, **interventions)
         self._create_graph = False
+        self._required = None
 
         # Set node-nr
         self._node_nr = {key: nr for nr, key in enumerate(self.__ordering)}
 
-        # Filter keys
-        if self._project_password is not None and interventions.get("password", None) == self._project_password:
+        # Filter keys (hidden nodes need password)
+        if cols is not None:
+            unknown = [key for key in cols if key not in self.__ordering or (key[0] == "_" and not password)]
+            if unknown:
+                raise ValueError(f"Unknown columns: {', '.join(map(str, unknown))}")
+            index = [key for key in self.__ordering if key in index]
+        elif password:
             index = self.__ordering
         else:
             index = [key for key in self.__ordering if key[0] != "_"]
 
-        # Make table
-        table = pd.DataFrame(data=[self._samples[key] for key in index], index=index, dtype=float).T
+        # Make table (one column at a time, as building it from rows is slow)
+        table = pd.DataFrame(
+            {key: self._output_column(self._samples[key]) for key in index}, columns=index, copy=False,
+        )
 
         # Reset
         self._interventions = None
         self._samples = None
         self._n_samples = None
+        self._fresh = []
+        self._moved = []
+
+        if self._profiler is not None:
+            self._profiler.end_sample(n_samples=n_samples)
 
         # Return
         return table
 
+    def _output_column(self, value):
+        # Whole numbers in smallest integer type that fits
+        dtype = self.float_dtype
+        if self.typed_integers and _whole_numbers(value):
+            low, high = (value.min(), value.max()) if value.size else (0, 0)
+            dtype = next((val for val in (np.int8, np.int16, np.int32, np.int64)
+                          if np.iinfo(val).min <= low and high <= np.iinfo(val).max), self.float_dtype)
+
+        # Arrays made for this sample are moved to the table (reused buffers and shared nodes are copied)
+        owned = any(value is val for val in self._fresh) and not any(value is val for val in self._buffers.values())
+        if owned and value.dtype == dtype and not any(value is val for val in self._moved):
+            value.flags.writeable = True
+            self._moved.append(value)
+            return value
+        return value.astype(dtype)
+
+    def _required_nodes(self, index, interventions):
+        # All nodes are sampled unless the system allows partial sampling, columns are requested and the structure is
+        #   known
+        if not self.partial_sampling or index is None or self._set_order is None or self._sample_all:
+            return None
+
+        # Requested nodes and their ancestors (ancestors of intervened nodes are not needed)
+        required = set()
+        stack = list(index)
+        while stack:
+            key = stack.pop()
+            if key not in required:
+                required.add(key)
+                if key not in interventions:
+                    stack.extend(self._ancestors.get(key, []))
+
+        if len(required) == len(self._set_order):
+            return None
+        return required
+
+    def _size(self):
+        # Number of samples to draw for the node being set (one if it is not needed)
+        if self._required is None or self._symbolic:
+            return self._n_samples
+        nr = len(self._set_order)
+        if nr < len(self._previous_set_order) and self._previous_set_order[nr] not in self._required:
+            return 1
+        return self._n_samples
+
+    def start_profiling(self, memory=False):
+        """
+        Records time, calls and reads of each node (and memory allocated if memory) in all following calls of
+        sample(), until stop_profiling() is called. Returns the SamplingProfiler with the statistics.
+        """
+        self._profiler = SamplingProfiler(memory=memory)
+        return self._profiler
+
+    def stop_profiling(self):
+        profiler, self._profiler = self._profiler, None
+        if profiler is not None:
+            profiler.stop()
+        return profiler
+
+    def moments(self, **interventions):
+        """
+        Exact means and covariances of nodes under interventions, for systems where all nodes are linear
+        combinations of the pre-made distributions (normal, binary, categorical).
+        Raises NonLinearSystemError for other systems (products of random nodes, sampling directly with numpy etc.).
+        Returns mean (series) and covariance (data-frame).
+        """
+        # Set (the ordering of the last sample is restored afterwards)
+        ordering, node_nr = self.__ordering, self._node_nr
+        self._interventions = interventions
+        self._samples = dict()
+        self.__ordering = []
+        self._n_samples = 0
+        self._noise_variances = []
+
+        # Trace structural equations symbolically
+        self._symbolic = True
+        try:
+            self._sample(n_samples=0)
+            terms = self._samples
+            noise_variances = self._noise_variances
+            traced_ordering = self.__ordering
+        finally:
+            self._symbolic = False
+            self._interventions = None
+            self._samples = None
+            self._n_samples = None
+            self._noise_variances = None
+            self.__ordering, self._node_nr = ordering, node_nr
+
+        # Filter keys
+        if self._project_password is not None and interventions.get("password", None) == self._project_password:
+            index = traced_ordering
+        else:
+            index = [key for key in traced_ordering if key[0] != "_"]
+
+        # Compute moments
+        mean, covariance = linear_moments(terms=[terms[key] for key in index], noise_variances=noise_variances)
+        return pd.Series(data=mean, index=index), pd.DataFrame(data=covariance, index=index, columns=index)
+
+    def _noise(self, mean, variance):
+        # New independent noise source (for exact moments)
+        self._noise_variances.append(variance)
+        return LinearTerm(constant=mean, coefficients={len(self._noise_variances) - 1: 1.})
+
     def __getitem__(self, item):
         # Remember as ancestor if building graph
         if self._create_graph:
             self._current_ancestors.append(item)
 
+        if self._profiler is not None and not self._symbolic:
+            self._profiler.read(item)
+
         # Return
         return self._samples[item]
 
@@ -80,16 +294,52 @@ class CausalSystem:
         # Assert new item
         assert isinstance(self._samples, dict) and key not in self._samples
 
+        # Symbolic nodes (for exact moments)
+        if self._symbolic:
+            self.__ordering.append(key)
+            if isinstance(self._interventions, dict) and key in self._interventions:
+                self._samples[key] = LinearTerm(constant=self._interventions[key])
+            else:
+                try:
+                    self._samples[key] = LinearTerm._as_term(value)
+                except NonLinearSystemError as error:
+                    raise NonLinearSystemError(f"Node {key} is not linear: {error}")
+            return
+
         # Set item
         self.__ordering.append(key)
-        self._samples[key] = np.array(value)
-
-        # Intervene if needed
+        value = np.asarray(value)
+
+        # Nodes must be set in the same order as in the previous sample, when only some nodes are sampled in full
+        if self._required is not None:
+            nr = len(self._set_order)
+            if nr >= len(self._previous_set_order) or self._previous_set_order[nr] != key:
+                raise _StructureChanged
+        self._set_order.append(key)
+
+        # Needed nodes drawn with a single sample (drawn before an earlier node was set, see sample())
+        if (self._required is not None and key in self._required and value.ndim and value.shape[0] != self._n_samples
+                and not (isinstance(self._interventions, dict) and key in self._interventions)):
+            self._sample_all = True
+            raise _StructureChanged
+
+        # Intervene if needed (a read-only view of the value, which is expanded when the table is made)
         if isinstance(self._interventions, dict) and key in self._interventions:
-            self._samples[key] = np.ones_like(self._samples[key]) * self._interventions[key]
+            intervention = self._interventions[key]
+            shape = value.shape
+            if self._required is not None and key in self._required:
+                shape = np.broadcast_shapes(shape, (self._n_samples,))
+            value = np.broadcast_to(np.asarray(intervention, dtype=np.result_type(value, intervention)), shape)
+
+        # Arrays drawn in this sample are stored as they are, other arrays are copied (the system may keep them between
+        #   samples, like a design matrix)
+        elif not any(value is val for val in self._fresh):
+            value = value.copy()
+            self._fresh.append(value)
 
         # Can no longer be changed (we do not allow circular graphs anyway)
-        self._samples[key].flags.writeable = False
+        value.flags.writeable = False
+        self._samples[key] = value
 
         # Make graph
         if self._create_graph:
@@ -104,6 +354,10 @@ class CausalSystem:
             # Reset temporary variables
             self._current_ancestors = []
 
+        # Time of structural equation
+        if self._profiler is not None:
+            self._profiler.set(key)
+
     @property
     def ancestors(self):
         return self._ancestors
@@ -142,6 +396,16 @@ class CausalSystem:
         return edge_set
 
     def check_correct_graph(self, edge_list):
+        return self.graph_diff(edge_list=edge_list)["correct"]
+
+    def graph_diff(self, edge_list):
+        """
+        Difference between a guessed graph and the true graph (casing is ignored).
+        Guesses without hidden nodes are compared to the true graph without hidden nodes.
+        Returns dictionary with the missing, extra and reversed edges of the guess (as sorted lists), the structural
+        Hamming distance (shd, number of edges to add, remove or reverse) and whether the guess is correct.
+        Takes time proportional to the number of edges.
+        """
         # Ensure python object
         for _ in range(3):
             if isinstance(edge_list, str):
@@ -150,15 +414,45 @@ class CausalSystem:
         # Format
         edge_set = set([(str(from_node).lower(), str(to_node).lower()) for from_node, to_node in edge_list])
 
-        # Get truth without caring about casing
-        true_edge_set = {(from_node.lower(), to_node.lower()) for from_node, to_node in self.edges}
+        # Truth with or without hidden nodes
+        true_edge_set, true_edge_set_wo_hidden = self._true_edge_sets()
+        has_hidden = any("_" in (from_node[:1], to_node[:1]) for from_node, to_node in edge_set)
+        truth = true_edge_set if has_hidden else true_edge_set_wo_hidden
+
+        # Differences
+        extra = edge_set - truth
+        missing = truth - edge_set
+        reversed_edges = {(from_node, to_node) for from_node, to_node in extra if (to_node, from_node) in missing}
+        extra -= reversed_edges
+        missing -= {(to_node, from_node) for from_node, to_node in reversed_edges}
+        shd = len(missing) + len(extra) + len(reversed_edges)
+
+        # Edges with the names of the nodes
+        names = {key.lower(): key for key in self.nodes}
+        named = lambda edges: sorted((names.get(from_node, from_node), names.get(to_node, to_node))
+                                     for from_node, to_node in edges)
+
+        return dict(
+            correct=shd == 0,
+            missing=named(missing),
+            extra=named(extra),
+            reversed=named(reversed_edges),
+            shd=shd,
+        )
+
+    def _true_edge_sets(self):
+        # Cached for the current graph (the graph is remade by each sample)
+        edges = self.edges
+        if self._true_edges_cache is None or self._true_edges_cache[0] != edges:
+            # Get truth without caring about casing
+            true_edge_set = frozenset((from_node.lower(), to_node.lower()) for from_node, to_node in edges)
 
-        # Get truth without hidden nodes
-        true_edge_set_wo_hidden = {(from_node, to_node) for from_node, to_node in true_edge_set
-                                   if "_" not in (from_node[0], to_node[0])}
+            # Get truth without hidden nodes
+            true_edge_set_wo_hidden = frozenset((from_node, to_node) for from_node, to_node in true_edge_set
+                                                if "_" not in (from_node[0], to_node[0]))
 
-        # Check
-        return edge_set == true_edge_set or edge_set == true_edge_set_wo_hidden
+            self._true_edges_cache = edges, (true_edge_set, true_edge_set_wo_hidden)
+        return self._true_edges_cache[1]
 
     @property
     def _ordering(self):
@@ -172,9 +466,18 @@ class CausalSystem:
                                                  f"Difference: {set(val) ^ set(self._ordering)}"
         self.__ordering = val
 
+    @property
+    def graph_hash(self):
+        return graph_hash(nodes=self.nodes, edges=self.edges)
+
     def draw_causal_graph(self):
+        # Plotting libraries are imported on first use to keep server startup fast
+        import networkx as nx
+        import matplotlib.pyplot as plt
+
         # Ensure sampled
-        _ = self.sample(1)
+        if not self.nodes:
+            _ = self.sample(1)
 
         # Make graph
         G = nx.DiGraph()
@@ -186,9 +489,9 @@ class CausalSystem:
         for ancesor, descendants in self.descendants.items():
             G.add_edges_from([(ancesor, val) for val in descendants])
 
-        # Sizes positions and labels for plot
+        # Sizes positions and labels for plot (layout is cached on disk)
         node_size = 2000
-        pos = graphviz_layout(G, prog="dot")
+        pos = cached_layout(nodes=list(G.nodes), edges=list(G.edges), prog="dot")
         labels = [val.strip("_") for val in self.nodes]
 
         # Plot
@@ -214,16 +517,121 @@ class CausalSystem:
         plt.xlim(x_lim)
         plt.ylim(y_lim)
 
+    def render_causal_graph(self, file_format="png"):
+        """
+        Rendered causal graph as bytes (eg. "png" or "svg").
+        Renders are cached on disk, so the graph only has to be drawn once per causal structure (renders with the
+        fallback layout are not cached, so graphviz is used when it becomes available).
+        """
+        import matplotlib.pyplot as plt
+
+        # Ensure sampled
+        if not self.nodes:
+            _ = self.sample(1)
+
+        # Check cache
+        render_path = Path(graph_cache_path, f"{self.graph_hash}.{file_format}")
+        if render_path.exists():
+            return render_path.read_bytes()
+
+        # Draw and render
+        self.draw_causal_graph()
+        buffer = BytesIO()
+        plt.savefig(buffer, format=file_format, bbox_inches="tight")
+        plt.close("all")
+        data = buffer.getvalue()
+
+        # Store (if the layout was made with graphviz)
+        if layout_cache_path(nodes=self.nodes, edges=self.edges, prog="dot").exists():
+            render_path.parent.mkdir(parents=True, exist_ok=True)
+            render_path.write_bytes(data)
+
+        return data
+
     ####################
     # Pre-made distributions
 
+    #   Samples are drawn from self.rng directly into buffers and transformed in-place, so each distribution
+    #   allocates at most one array (buffers are reused by the next sample of the same size).
+
+    def seed(self, seed=None):
+        """
+        Seeds the random generator of the pre-made distributions.
+        """
+        self.rng = np.random.default_rng(seed)
+
+    def _draw_shape(self, *parameters):
+        # Shape of a draw (parameters that are nodes make the draw as large as the nodes)
+        return np.broadcast_shapes((self._size(),), *[np.shape(val) for val in parameters])
+
+    def _buffer(self, *parameters):
+        # Buffer for a draw (buffers are kept by draw number and shape, so samples of a size reuse the buffers of the
+        #   previous sample of that size)
+        key = (self._n_buffers, self._draw_shape(*parameters))
+        self._n_buffers += 1
+        if key in self._buffers:
+            buffer = self._buffers[key] = self._buffers.pop(key)  # Most recently used last
+            buffer.flags.writeable = True
+            self._fresh.append(buffer)
+            return buffer
+
+        # New buffer (kept if there is room, after dropping the least recently used buffers)
+        buffer = np.empty(key[1])
+        if buffer.nbytes <= self.buffer_max_bytes:
+            while sum(val.nbytes for val in self._buffers.values()) + buffer.nbytes > self.buffer_max_bytes:
+                del self._buffers[next(iter(self._buffers))]
+            self._buffers[key] = buffer
+        self._fresh.append(buffer)
+        return buffer
+
     def normal(self, mu, std):
-        return np.random.randn(self._n_samples) * std + mu
+        if self._symbolic:
+            return mu + std * self._noise(mean=0., variance=1.)
+        samples = self.rng.standard_normal(out=self._buffer(mu, std))
+        samples *= std
+        samples += mu
+        return samples
+
+    def uniform(self, low=0., high=1.):
+        if self._symbolic:
+            return self._noise(mean=(low + high) / 2, variance=(high - low) ** 2 / 12)
+        samples = self.rng.random(out=self._buffer(low, high))
+        samples *= high - low
+        samples += low
+        return samples
+
+    def beta(self, a, b):
+        if self._symbolic:
+            return self._noise(mean=a / (a + b), variance=a * b / ((a + b) ** 2 * (a + b + 1)))
+
+        # Ratio of gamma-samples: X / (X + Y) with X ~ Gamma(a) and Y ~ Gamma(b)
+        samples = self.rng.standard_gamma(a, out=self._buffer(a, b))
+        total = self.rng.standard_gamma(b, out=self._buffer(a, b))
+        total += samples
+        samples /= total
+        return samples
+
+    def poisson(self, lam):
+        if self._symbolic:
+            return self._noise(mean=lam, variance=lam)
+        # Integers as floats (numpy can not draw these into a buffer)
+        samples = self.rng.poisson(lam=lam, size=self._draw_shape(lam)).astype(float)
+        self._fresh.append(samples)
+        return samples
 
     def categorical(self, probabilities):
         probabilities = np.array(probabilities) / np.sum(probabilities)
-        choices = np.array(list(range(len(probabilities))), dtype=np.float)
-        return np.random.choice(a=choices, size=self._n_samples, replace=True, p=probabilities)
+        if self._symbolic:
+            values = np.arange(len(probabilities))
+            mean = np.sum(values * probabilities)
+            return self._noise(mean=mean, variance=np.sum(values ** 2 * probabilities) - mean ** 2)
+
+        # Category is the number of cumulative probabilities at or below a uniform sample (as float)
+        cumulative = np.cumsum(probabilities)
+        cumulative[-1] = np.inf
+        samples = self.rng.random(out=self._buffer())
+        samples[...] = np.searchsorted(cumulative, samples, side="right")
+        return samples
 
     def binary(self, p_success):
         return self.categorical(probabilities=np.array([1 - p_success, p_success]))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+# Cache of layouts and rendered graphs (keyed by hash of nodes and edges)
+graph_cache_path = Path(Path(__file__).parent.parent, "storage", "_graph_cache")
+
+
+def graph_hash(nodes, edges):
+    # Canonical representation of the node/edge set
+    description = json.dumps(dict(
+        nodes=sorted(str(val) for val in nodes),
+        edges=sorted([str(from_node), str(to_node)] for from_node, to_node in edges),
+    ))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def layered_layout(nodes, edges, layer_distance=100., node_distance=100.):
+    """
+    Pure-python layered layout (similar to what "dot" does for small graphs).
+    Each node is placed on the layer of its longest path from a root, and nodes are spread out within the layer.
+    """
+    nodes = list(nodes)
+    ancestors = {node: [] for node in nodes}
+    for from_node, to_node in edges:
+        ancestors[to_node].append(from_node)
+
+    # Longest path from a root (graph is acyclic)
+    layers = dict()
+
+    def layer_of(node):
+        if node not in layers:
+            layers[node] = 1 + max([layer_of(val) for val in ancestors[node]], default=-1)
+        return layers[node]
+
+    for node in nodes:
+        layer_of(node)
+
+    # Order within layers by the mean position of ancestors to reduce crossings
+    n_layers = max(layers.values(), default=-1) + 1
+    x_positions = dict()
+    for layer in range(n_layers):
+        layer_nodes = [node for node in nodes if layers[node] == layer]
+        layer_nodes.sort(key=lambda node: (
+            sum(x_positions[val] for val in ancestors[node]) / max(len(ancestors[node]), 1),
+            nodes.index(node)
+        ))
+        width = (len(layer_nodes) - 1) * node_distance
+        for nr, node in enumerate(layer_nodes):
+            x_positions[node] = nr * node_distance - width / 2
+
+    # Roots at the top, as with "dot"
+    return {node: (x_positions[node], (n_layers - 1 - layers[node]) * layer_distance) for node in nodes}
+
+
+def layout_cache_path(nodes, edges, prog="dot"):
+    # Cached layout (only exists if made with graphviz)
+    return Path(graph_cache_path, f"{graph_hash(nodes=nodes, edges=edges)}_{prog}.json")
+
+
+def cached_layout(nodes, edges, prog="dot"):
+    # Check cache
+    layout_path = layout_cache_path(nodes=nodes, edges=edges, prog=prog)
+    if layout_path.exists():
+        with layout_path.open("r") as file:
+            return {key: tuple(val) for key, val in json.load(file).items()}
+
+    # Use graphviz if available
+    pos = None
+    if shutil.which(prog) is not None:
+        try:
+            import networkx as nx
+            from networkx.drawing.nx_pydot import graphviz_layout
+
+            G = nx.DiGraph()
+            G.add_nodes_from(nodes)
+            G.add_edges_from(edges)
+            pos = graphviz_layout(G, prog=prog)
+        except (ImportError, OSError, AssertionError):
+            pos = None
+
+    # Fall back to pure-python layout (not cached, so graphviz is used when it becomes available)
+    if not pos:
+        return layered_layout(nodes=nodes, edges=edges)
+
+    # Store
+    pos = {key: (float(x), float(y)) for key, (x, y) in pos.items()}
+    layout_path.parent.mkdir(parents=True, exist_ok=True)
+    with layout_path.open("w") as file:
+        json.dump(pos, file)
+
+    return pos
@@ -0,0 +1,226 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# Version of the snapshot format (written to the metadata-file)
+snapshot_version = 1
+
+
+def migrate_shelf(db, handled_ids, email_log):
+    """
+    Moves ids and emails of shelves written by older servers (whole sets and dictionaries under "ids",
+    "success_ids" and "emails") to the snapshot of handled ids and the email log.
+    """
+    if "ids" not in db:
+        return
+    handled_ids.write(ids=db["ids"], success_ids=db.get("success_ids", set()))
+    email_log.add_many(emails=db.get("emails", dict()))
+    for key in ("ids", "success_ids", "emails"):
+        if key in db:
+            del db[key]
+
+
+class EmailLog:
+    """
+    Log of handled emails (message, subject, sender and success) in SQLite.
+    Emails are added one at a time and the log is only read when it is inspected, as it grows with every email.
+    The log can be used from multiple threads.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS emails (
+                    message_id INTEGER PRIMARY KEY,
+                    message TEXT,
+                    subject TEXT,
+                    sender TEXT,
+                    success INTEGER NOT NULL
+                )
+            """)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM emails").fetchone()[0]
+
+    def add(self, message_id, message, subject, sender, success):
+        self.add_many(emails={message_id: dict(message=message, subject=subject, sender=sender, success=success)})
+
+    def add_many(self, emails):
+        """
+        Adds dictionary from message-ids to emails (replacing emails with the same ids).
+        """
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?)",
+                [(int(message_id), email["message"], email["subject"], email["sender"], int(email["success"]))
+                 for message_id, email in emails.items()],
+            )
+
+    def clear(self):
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM emails")
+
+    def to_dict(self):
+        """
+        Dictionary from message-ids to emails (message, subject, sender and success), as in shelves of older servers.
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT message_id, message, subject, sender, success FROM emails ORDER BY message_id"
+            ).fetchall()
+        return {message_id: dict(message=message, subject=subject, sender=sender, success=bool(success))
+                for message_id, message, subject, sender, success in rows}
+
+
+def _sorted_contains(array, value):
+    pos = np.searchsorted(array, value)
+    return pos < array.shape[0] and array[pos] == value
+
+
+class HandledIds:
+    """
+    Ids of handled emails and of the successful ones, stored as a snapshot of sorted arrays in .npy-files and a
+    journal of ids handled since the snapshot was written.
+    The arrays are memory-mapped and searched by bisection, so starting the server takes the same time regardless of
+    the number of handled emails. The journal is merged into a new snapshot when it has max_journal ids. Snapshots
+    are numbered by generations, which are switched by atomically replacing the metadata-file.
+    """
+    def __init__(self, path, max_journal=1000):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_journal = max_journal
+        self._lock = threading.Lock()
+
+        # Current snapshot
+        meta = self._read_meta()
+        self.generation = meta["generation"]
+        self._ids = self._load(self._file("ids", self.generation))
+        self._success_ids = self._load(self._file("success", self.generation))
+
+        # Ids handled since snapshot (records of message-id and success)
+        journal_path = self._file("journal", self.generation)
+        records = np.zeros((0, 2), dtype=np.int64)
+        if journal_path.exists():
+            record_bytes = 2 * np.dtype(np.int64).itemsize
+            n_records = journal_path.stat().st_size // record_bytes
+            os.truncate(journal_path, n_records * record_bytes)  # Drop record cut off by a crash
+            records = np.fromfile(str(journal_path), dtype=np.int64).reshape(n_records, 2)
+        self._journal_ids = set(records[:, 0].tolist())
+        self._journal_success_ids = set(records[records[:, 1] != 0, 0].tolist())
+
+    def _file(self, kind, generation):
+        suffix = "bin" if kind == "journal" else "npy"
+        return Path(self.path.parent, f"{self.path.name}_{kind}_{generation}.{suffix}")
+
+    @property
+    def _meta_path(self):
+        return Path(self.path.parent, f"{self.path.name}.json")
+
+    def _read_meta(self):
+        if not self._meta_path.exists():
+            return dict(version=snapshot_version, generation=0)
+        meta = json.loads(self._meta_path.read_text())
+        if meta.get("version", None) != snapshot_version:
+            raise ValueError(f"Snapshot of handled ids has version {meta.get('version', None)}, "
+                             f"but this server reads version {snapshot_version}: {self._meta_path}")
+        return meta
+
+    @staticmethod
+    def _load(path):
+        if not path.exists():
+            return np.zeros(0, dtype=np.int64)
+        return np.load(str(path), mmap_mode="r")
+
+    def __contains__(self, message_id):
+        message_id = int(message_id)
+        return message_id in self._journal_ids or _sorted_contains(self._ids, message_id)
+
+    def __len__(self):
+        return self._ids.shape[0] + len(self._journal_ids)
+
+    def __iter__(self):
+        return iter(self.ids().tolist())
+
+    def is_success(self, message_id):
+        message_id = int(message_id)
+        return message_id in self._journal_success_ids or _sorted_contains(self._success_ids, message_id)
+
+    def ids(self):
+        """
+        Sorted array of all handled ids.
+        """
+        return np.union1d(self._ids, np.fromiter(self._journal_ids, dtype=np.int64))
+
+    def success_ids(self):
+        """
+        Sorted array of the ids of successful emails.
+        """
+        return np.union1d(self._success_ids, np.fromiter(self._journal_success_ids, dtype=np.int64))
+
+    def add(self, message_id, success):
+        """
+        Stores id of handled email (already handled ids are ignored).
+        """
+        message_id = int(message_id)
+        with self._lock:
+            if message_id in self:
+                return
+            with open(self._file("journal", self.generation), "ab") as file:
+                file.write(np.array([message_id, int(success)], dtype=np.int64).tobytes())
+            self._journal_ids.add(message_id)
+            if success:
+                self._journal_success_ids.add(message_id)
+
+            if len(self._journal_ids) >= self.max_journal:
+                self._write_snapshot(ids=self.ids(), success_ids=self.success_ids())
+
+    def write(self, ids, success_ids):
+        """
+        Replaces all ids with a new snapshot (eg. when rebuilding the server's memory).
+        """
+        with self._lock:
+            self._write_snapshot(
+                ids=np.unique(np.fromiter(ids, dtype=np.int64)),
+                success_ids=np.unique(np.fromiter(success_ids, dtype=np.int64)),
+            )
+
+    def _write_snapshot(self, ids, success_ids):
+        old_generation, generation = self.generation, self.generation + 1
+
+        # Write files of new generation before switching to it, so a crash leaves the old snapshot intact
+        np.save(str(self._file("ids", generation)), ids, allow_pickle=False)
+        np.save(str(self._file("success", generation)), success_ids, allow_pickle=False)
+        temp_path = Path(self.path.parent, f"{self._meta_path.name}.tmp")
+        temp_path.write_text(json.dumps(dict(
+            version=snapshot_version, generation=generation, n_ids=int(ids.shape[0]),
+            n_success_ids=int(success_ids.shape[0]),
+        )))
+        os.replace(temp_path, self._meta_path)
+
+        # Use new generation
+        self.generation = generation
+        self._ids = self._load(self._file("ids", generation))
+        self._success_ids = self._load(self._file("success", generation))
+        self._journal_ids = set()
+        self._journal_success_ids = set()
+
+        # Remove old generation (can fail on platforms where it is still memory-mapped elsewhere)
+        for kind in ("ids", "success", "journal"):
+            try:
+                self._file(kind, old_generation).unlink(missing_ok=True)
+            except OSError:
+                pass
@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+
+class JobQueue:
+    """
+    Durable record of the stage each email has reached, so a restarted server can resume emails idempotently.
+        received: Email is being handled.
+        sampled:  Samples are in the sample store (resumed emails send the same samples).
+        rendered: Data-files are written.
+        sent:     Reply is sent (resumed emails are not answered again).
+    Jobs are removed when the email is stored in the persistent memory of the server.
+    A crash between sending a reply and recording it as sent can still cause one duplicate reply.
+    """
+    stages = ["received", "sampled", "rendered", "sent"]
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    message_id INTEGER PRIMARY KEY,
+                    subject TEXT,
+                    sender TEXT,
+                    stage TEXT NOT NULL,
+                    received REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def reached(cls, stage, target):
+        return stage is not None and cls.stages.index(stage) >= cls.stages.index(target)
+
+    def start(self, message_id, subject, sender):
+        """
+        Registers email and returns the stage it has reached (an email not seen before is "received").
+        """
+        now = datetime.now().timestamp()
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, ?, ?)",
+                (int(message_id), subject, sender, "received", now, now),
+            )
+            return self.connection.execute(
+                "SELECT stage FROM jobs WHERE message_id = ?", (int(message_id),)
+            ).fetchone()[0]
+
+    def set_stage(self, message_id, stage):
+        assert stage in self.stages
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET stage = ?, updated = ? WHERE message_id = ?",
+                (stage, datetime.now().timestamp(), int(message_id)),
+            )
+
+    def finish(self, message_id):
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM jobs WHERE message_id = ?", (int(message_id),))
+
+    def unfinished(self):
+        """
+        List of (message_id, subject, sender, stage) of jobs that were not finished, oldest first.
+        """
+        with self._lock:
+            return self.connection.execute(
+                "SELECT message_id, subject, sender, stage FROM jobs ORDER BY received, message_id"
+            ).fetchall()
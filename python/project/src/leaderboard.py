@@ -0,0 +1,78 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+
+
+class Leaderboard:
+    """
+    Competition leaderboard kept sorted by cost, so ranks can be found by binary search.
+    Ties are broken by the time users finished (users finishing at an unknown time count as finishing first).
+    Adding a user inserts into a list, which is O(n), but a fast memory move for the number of users of a course.
+    """
+    def __init__(self, experiment_cost, sample_cost, incorrect_guess_cost):
+        self.experiment_cost = experiment_cost
+        self.sample_cost = sample_cost
+        self.incorrect_guess_cost = incorrect_guess_cost
+
+        # Sorted list of (cost, finish-time, user) and the entry of each user
+        self._entries = []
+        self._user_entries = dict()
+
+    @classmethod
+    def from_users(cls, users, experiment_cost, sample_cost, incorrect_guess_cost, done_times=None):
+        """
+        Leaderboard of finished users, where done_times has the time each user finished (like
+        StatsDatabase.done_times()).
+        """
+        leaderboard = cls(
+            experiment_cost=experiment_cost, sample_cost=sample_cost, incorrect_guess_cost=incorrect_guess_cost
+        )
+        done_times = done_times or dict()
+        for user, user_info in users.items():
+            if "done" in user_info:
+                leaderboard.add(user=user, done=user_info["done"], time=done_times.get(user, 0.))
+        return leaderboard
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user):
+        return user in self._user_entries
+
+    def cost(self, done):
+        n_experiments, n_samples, incorrect_guesses = done
+        return (
+            n_experiments * self.experiment_cost
+            + n_samples * self.sample_cost
+            + incorrect_guesses * self.incorrect_guess_cost
+        )
+
+    def add(self, user, done, time=None):
+        # Users only finish once (time is when the user finished, default is now)
+        if user in self._user_entries:
+            return
+
+        time = datetime.now().timestamp() if time is None else time
+        entry = (self.cost(done=done), time, user)
+        insort(self._entries, entry)
+        self._user_entries[user] = entry
+
+    def rank(self, user):
+        """
+        Rank of user (1 is best) or None if user has not finished.
+        """
+        entry = self._user_entries.get(user, None)
+        if entry is None:
+            return None
+        return bisect_left(self._entries, entry) + 1
+
+    def rank_of_cost(self, cost):
+        """
+        Rank a user would get by finishing now with given cost.
+        """
+        return bisect_right(self._entries, (cost, float("inf"))) + 1
+
+    def top(self, k):
+        """
+        List of (user, cost) for the k best users.
+        """
+        return [(user, cost) for cost, _, user in self._entries[:k]]
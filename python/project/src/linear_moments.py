@@ -0,0 +1,93 @@
+import numbers
+
+import numpy as np
+
+
+class NonLinearSystemError(ValueError):
+    pass
+
+
+class LinearTerm:
+    """
+    Affine combination of independent noise sources: constant + sum_i coefficients[i] * noise_i.
+    Used to trace structural equations symbolically, so means and covariances can be computed exactly.
+    Only linear operations are allowed. Anything else (products of random terms, numpy sampling etc.) raises
+    NonLinearSystemError.
+    """
+    # Make numpy defer to the operators of this class
+    __array_ufunc__ = None
+
+    def __init__(self, constant=0., coefficients=None):
+        self.constant = float(constant)
+        self.coefficients = dict() if coefficients is None else coefficients
+
+    @staticmethod
+    def _as_term(other):
+        if isinstance(other, LinearTerm):
+            return other
+        if isinstance(other, numbers.Real) or (isinstance(other, np.ndarray) and other.ndim == 0):
+            return LinearTerm(constant=float(other))
+        raise NonLinearSystemError(f"Can not combine {type(other).__name__} with linear term.")
+
+    @property
+    def is_constant(self):
+        return not any(self.coefficients.values())
+
+    def __add__(self, other):
+        other = self._as_term(other)
+        coefficients = dict(self.coefficients)
+        for key, val in other.coefficients.items():
+            coefficients[key] = coefficients.get(key, 0.) + val
+        return LinearTerm(constant=self.constant + other.constant, coefficients=coefficients)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return self * -1.
+
+    def __pos__(self):
+        return self
+
+    def __sub__(self, other):
+        return self + (-self._as_term(other))
+
+    def __rsub__(self, other):
+        return self._as_term(other) + (-self)
+
+    def __mul__(self, other):
+        other = self._as_term(other)
+        if other.is_constant:
+            scale, term = other.constant, self
+        elif self.is_constant:
+            scale, term = self.constant, other
+        else:
+            raise NonLinearSystemError("Product of two random terms is not linear.")
+        return LinearTerm(
+            constant=term.constant * scale,
+            coefficients={key: val * scale for key, val in term.coefficients.items()},
+        )
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        other = self._as_term(other)
+        if not other.is_constant:
+            raise NonLinearSystemError("Division by random term is not linear.")
+        return self * (1. / other.constant)
+
+
+def linear_moments(terms, noise_variances):
+    """
+    Exact mean-vector and covariance-matrix of linear terms of independent noise sources with given variances.
+    """
+    noise_variances = np.asarray(noise_variances, dtype=float)
+    mean = np.array([term.constant for term in terms])
+
+    # Coefficient matrix (terms x noise sources)
+    coefficients = np.zeros((len(terms), len(noise_variances)))
+    for nr, term in enumerate(terms):
+        for key, val in term.coefficients.items():
+            coefficients[nr, key] = val
+
+    covariance = (coefficients * noise_variances) @ coefficients.T
+    return mean, covariance
@@ -0,0 +1,234 @@
+import heapq
+import itertools
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+
+
+class _OutboundEmail:
+    # Email in the queue (coalesced error-replies have several message-ids and subjects)
+    def __init__(self, message_id, kind, send_to, subject, text, files, n_bytes, due):
+        self.message_ids = [message_id]
+        self.kind = kind
+        self.send_to = send_to
+        self.subjects = [subject]
+        self.text = text
+        self.files = files
+        self.n_bytes = n_bytes
+        self.due = due
+        self.attempts = 0
+
+    @property
+    def subject(self):
+        if len(self.subjects) == 1:
+            return self.subjects[0]
+        return f"{self.subjects[0]} (and {len(self.subjects) - 1} more)"
+
+    @property
+    def body(self):
+        if len(self.subjects) == 1:
+            return self.text
+        return "\n".join(self.subjects) + "\n\n" + self.text
+
+
+class MailScheduler:
+    """
+    Queue of replies, sent in order of priority at the rate allowed by the email provider.
+    Guess-answers are sent first, then data (smallest attachments first) and last error-replies. Sending is paced by a
+    token bucket, which allows bursts of burst emails and rate emails per second on average (None for no limit).
+    Error-replies to the same address are held for coalesce_seconds, and errors arriving meanwhile are answered in the
+    same email, so a burst of bad emails does not use up the sending limit. Emails that cannot be sent due to network
+    errors are retried after retry_seconds, up to max_attempts times, and emails failing with other errors are given up.
+    send(send_to, subject, text, files, message_ids) sends an email answering the emails of message_ids and
+    done(message_id, sent) is called when the reply to an email is sent or given up. Errors are reported with
+    report(text). The queue can be used from multiple threads.
+    """
+    kinds = ["guess", "data", "error"]
+
+    def __init__(self, send, done, rate=None, burst=1, coalesce_seconds=None, retry_seconds=60, max_attempts=3,
+                 report=print):
+        self.send = send
+        self.done = done
+        self.report = report
+        self.rate = rate
+        self.burst = burst
+        self.coalesce_seconds = coalesce_seconds
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.n_failed = 0
+
+        # Emails ready to send (by priority) and emails held until they are due (by time)
+        self._ready = []
+        self._held = []
+        self._order = itertools.count()
+
+        # Queued error-replies by address and number of queued replies of each message-id
+        self._errors = dict()
+        self._pending = defaultdict(int)
+
+        # Token bucket
+        self._tokens = burst
+        self._refilled = monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ready) + len(self._held)
+
+    def __contains__(self, message_id):
+        with self._lock:
+            return self._pending.get(message_id, 0) > 0
+
+    def submit(self, message_id, kind, send_to, subject, text, files=None, n_bytes=0):
+        """
+        Queues reply to email (kind is "guess", "data" or "error").
+        """
+        assert kind in self.kinds
+        now = monotonic()
+        with self._lock:
+            self._pending[message_id] += 1
+
+            # Coalesce with queued error-reply to the same address
+            if kind == "error" and self.coalesce_seconds and send_to in self._errors:
+                email = self._errors[send_to]
+                email.message_ids.append(message_id)
+                email.subjects.append(subject)
+                return
+
+            email = _OutboundEmail(message_id=message_id, kind=kind, send_to=send_to, subject=subject, text=text,
+                                   files=files, n_bytes=n_bytes, due=now)
+            if kind == "error" and self.coalesce_seconds:
+                self._errors[send_to] = email
+                email.due = now + self.coalesce_seconds
+                heapq.heappush(self._held, (email.due, next(self._order), email))
+            else:
+                self._push_ready(email)
+
+    def _push_ready(self, email):
+        heapq.heappush(self._ready, (self.kinds.index(email.kind), email.n_bytes, next(self._order), email))
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def pop_due(self, hold=True):
+        """
+        Next email to send, or None if no email is due or the sending limit is reached.
+        With hold=False error-replies are not held for coalescing (eg. before the server stops).
+        """
+        now = monotonic()
+        with self._lock:
+
+            # Move due emails to the ready-queue (and error-replies held for coalescing if not hold)
+            if not hold:
+                released = [email for _, _, email in self._held if email.attempts == 0]
+                self._held = [val for val in self._held if val[2].attempts > 0]
+                heapq.heapify(self._held)
+                for email in released:
+                    self._push_ready(email)
+            while self._held and self._held[0][0] <= now:
+                _, _, email = heapq.heappop(self._held)
+                self._push_ready(email)
+
+            # Take token
+            self._refill(now=now)
+            if not self._ready or (self.rate is not None and self._tokens < 1):
+                return None
+            self._tokens -= 1
+
+            _, _, _, email = heapq.heappop(self._ready)
+            if self._errors.get(email.send_to, None) is email:
+                del self._errors[email.send_to]
+            email.attempts += 1
+            return email
+
+    def seconds_to_next(self):
+        """
+        Seconds until an email can be sent (None if the queue is empty).
+        """
+        now = monotonic()
+        with self._lock:
+            if not self._ready and not self._held:
+                return None
+            self._refill(now=now)
+            wait_token = 0. if self.rate is None else max(0., (1 - self._tokens) / self.rate)
+            wait_email = 0. if self._ready else max(0., self._held[0][0] - now)
+            return max(wait_token, wait_email)
+
+    def send_email(self, email):
+        """
+        Sends email returned by pop_due. Emails that fail due to network errors are queued again, until they have been
+        tried max_attempts times. Returns True if the email was sent.
+        """
+        try:
+            self.send(send_to=email.send_to, subject=email.subject, text=email.body, files=email.files,
+                      message_ids=email.message_ids)
+        except OSError as error:
+            self.report(f"Could not send email to {email.send_to} (attempt {email.attempts}): {error!r}")
+            if email.attempts < self.max_attempts:
+                with self._lock:
+                    email.due = monotonic() + self.retry_seconds
+                    heapq.heappush(self._held, (email.due, next(self._order), email))
+                return False
+            self._finish(email=email, sent=False)
+            return False
+        except Exception as error:
+            self.report(f"Could not send email to {email.send_to}: {error!r}")
+            self._finish(email=email, sent=False)
+            return False
+
+        self._finish(email=email, sent=True)
+        return True
+
+    def _finish(self, email, sent):
+        # Replies are no longer pending before done is called (so the server can tell if a job is finished)
+        with self._lock:
+            self.n_failed += not sent
+            for message_id in email.message_ids:
+                self._pending[message_id] -= 1
+                if self._pending[message_id] <= 0:
+                    del self._pending[message_id]
+        for message_id in email.message_ids:
+            try:
+                self.done(message_id, sent)
+            except Exception as error:
+                self.report(f"Could not finish reply to email {message_id}: {error!r}")
+
+    def send_due(self, hold=True):
+        """
+        Sends emails until no email is due or the sending limit is reached. Returns the number of emails sent.
+        """
+        n_sent = 0
+        email = self.pop_due(hold=hold)
+        while email is not None:
+            n_sent += self.send_email(email)
+            email = self.pop_due(hold=hold)
+        return n_sent
+
+    def send_for(self, seconds):
+        """
+        Sends emails as they become due for seconds (sleeping in between). Returns the number of emails sent.
+        """
+        deadline = monotonic() + seconds
+        n_sent = self.send_due()
+        while monotonic() < deadline:
+            wait = self.seconds_to_next()
+            sleep(max(0., min(deadline - monotonic(), 1. if wait is None else wait)))
+            n_sent += self.send_due()
+        return n_sent
+
+    def flush(self):
+        """
+        Sends all queued emails, without holding error-replies for coalescing, but within the sending limit.
+        Emails waiting to be retried are left in the queue.
+        """
+        n_sent = self.send_due(hold=False)
+        with self._lock:
+            n_waiting = len(self._ready)
+        while n_waiting:
+            sleep(self.seconds_to_next() or 0.)
+            n_sent += self.send_due(hold=False)
+            with self._lock:
+                n_waiting = len(self._ready)
+        return n_sent
@@ -0,0 +1,284 @@
+import re
+import socketserver
+import threading
+from email import policy
+from email.parser import BytesParser
+from email.utils import formatdate, parseaddr
+from time import perf_counter
+
+# Tokens of IMAP commands: quoted strings, parenthesised lists (kept whole) and atoms
+_imap_token = re.compile(r'"((?:[^"\\]|\\.)*)"|(\((?:[^()]|\([^()]*\))*\))|([^\s()"]+)')
+
+
+class Mailbox:
+    """
+    Thread-safe inbox and outbox shared by the IMAP and SMTP stand-ins.
+    Messages in the inbox have uid, flags, sender, raw bytes and the time they were delivered (perf_counter).
+    Sent emails have the time they were received, sender, recipients, subject, size in bytes and the uids of the
+    emails they reply to (header X-Reply-To-Ids).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.changed = threading.Condition(self._lock)
+        self.inbox = dict()
+        self.sent = []
+        self._next_uid = 1
+
+    def deliver(self, sender, subject, send_to="server@localhost"):
+        """
+        Puts email from sender in inbox and returns its uid.
+        """
+        message = (
+            f"From: {sender}\r\nTo: {send_to}\r\nSubject: {subject}\r\nDate: {formatdate()}\r\n\r\n{subject}\r\n"
+        ).encode()
+        with self.changed:
+            uid = self._next_uid
+            self._next_uid += 1
+            self.inbox[uid] = dict(flags=set(), sender=sender, message=message, delivered=perf_counter())
+            self.changed.notify_all()
+        return uid
+
+    def n_messages(self):
+        with self._lock:
+            return len(self.inbox)
+
+    def uids(self, criteria):
+        # Criteria like "NOT DELETED UNSEEN UNKEYWORD $Handled" (flags and keywords are case-insensitive)
+        tokens = criteria.upper().split()
+        keywords = {tokens[nr + 1] for nr, val in enumerate(tokens[:-1]) if val == "KEYWORD"}
+        unkeywords = {tokens[nr + 1] for nr, val in enumerate(tokens[:-1]) if val == "UNKEYWORD"}
+        with self._lock:
+            uids = []
+            for uid, val in self.inbox.items():
+                flags = {flag.upper() for flag in val["flags"]}
+                if "NOT DELETED" in criteria.upper() and "\\DELETED" in flags:
+                    continue
+                if "UNSEEN" in tokens and "\\SEEN" in flags:
+                    continue
+                if "SEEN" in tokens and "\\SEEN" not in flags:
+                    continue
+                if not keywords <= flags or unkeywords & flags:
+                    continue
+                uids.append(uid)
+            return uids
+
+    def message(self, uid):
+        with self._lock:
+            return self.inbox[uid]["message"]
+
+    def add_flags(self, uids, flags):
+        with self._lock:
+            for uid in uids:
+                if uid in self.inbox:
+                    self.inbox[uid]["flags"].update(flags)
+
+    def receive(self, sender, recipients, data):
+        headers = BytesParser(policy=policy.default).parsebytes(data, headersonly=True)
+        with self._lock:
+            self.sent.append(dict(
+                received=perf_counter(),
+                sender=sender,
+                recipients=recipients,
+                subject=str(headers.get("Subject", "")),
+                reply_to_ids=[int(val) for val in str(headers.get("X-Reply-To-Ids", "")).split(",") if val.strip()],
+                n_bytes=len(data),
+            ))
+
+    def n_sent(self):
+        with self._lock:
+            return len(self.sent)
+
+
+def _message_ids(text):
+    # Message sets like "1,3,5:7"
+    ids = []
+    for part in text.split(","):
+        start, _, end = part.partition(":")
+        ids.extend(range(int(start), int(end) + 1) if end else [int(start)])
+    return ids
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    """
+    The subset of IMAP4rev1 used by the server: LOGIN, SELECT/EXAMINE, UID SEARCH, UID FETCH of headers,
+    UID STORE of flags and keywords, IDLE, NOOP and LOGOUT. Everything else is answered with BAD.
+    """
+    capabilities = "IMAP4rev1 IDLE AUTH=PLAIN"
+
+    def write(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else (line + "\r\n").encode())
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.write(f"* OK [CAPABILITY {self.capabilities}] Stand-in IMAP ready")
+
+        for line in self.rfile:
+            tokens = [a or b or c for a, b, c in _imap_token.findall(line.decode().strip())]
+            if len(tokens) < 2:
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+
+            # UID-commands (message-ids of the stand-in are uids)
+            if command == "UID" and args:
+                command, args = args[0].upper(), args[1:]
+
+            if command == "CAPABILITY":
+                self.write(f"* CAPABILITY {self.capabilities}")
+            elif command in ("LOGIN", "NOOP", "CHECK", "CLOSE"):
+                pass
+            elif command in ("SELECT", "EXAMINE"):
+                self.write(f"* {mailbox.n_messages()} EXISTS")
+                self.write("* 0 RECENT")
+                self.write("* OK [UIDVALIDITY 1] UIDs valid")
+                self.write("* FLAGS (\\Seen \\Deleted)")
+                self.write("* OK [PERMANENTFLAGS (\\Seen \\Deleted \\*)] Keywords can be added")
+            elif command == "SEARCH":
+                uids = mailbox.uids(criteria=" ".join(val.upper() for val in args))
+                self.write("* SEARCH" + "".join(f" {val}" for val in uids))
+            elif command == "FETCH":
+                for uid in _message_ids(args[0]):
+                    message = mailbox.message(uid)
+                    headers = b"".join(
+                        val + b"\r\n" for val in message.split(b"\r\n\r\n", 1)[0].split(b"\r\n")
+                        if val.lower().startswith((b"subject:", b"from:"))
+                    ) + b"\r\n"
+                    self.write(f"* {uid} FETCH (UID {uid} BODY[HEADER.FIELDS (SUBJECT FROM)] {{{len(headers)}}}")
+                    self.write(headers + b")\r\n")
+            elif command == "STORE":
+                flags = set(args[-1].strip("()").split())
+                mailbox.add_flags(uids=_message_ids(args[0]), flags=flags)
+                for uid in _message_ids(args[0]):
+                    self.write(f"* {uid} FETCH (UID {uid} FLAGS ({' '.join(sorted(flags))}))")
+            elif command == "IDLE":
+                self.idle(tag=tag)
+                continue
+            elif command == "LOGOUT":
+                self.write("* BYE Stand-in IMAP logging out")
+                self.write(f"{tag} OK LOGOUT completed")
+                return
+            else:
+                self.write(f"{tag} BAD Command not supported by stand-in")
+                continue
+            self.write(f"{tag} OK {command} completed")
+
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        self.write("+ idling")
+        self.wfile.flush()
+
+        # Report new emails until client sends DONE
+        n_messages = mailbox.n_messages()
+        waiter = threading.Thread(target=self._report_new_emails, args=(n_messages,), daemon=True)
+        self._idling = True
+        waiter.start()
+        self.rfile.readline()
+        self._idling = False
+        with mailbox.changed:
+            mailbox.changed.notify_all()
+        waiter.join()
+        self.write(f"{tag} OK IDLE terminated")
+
+    def _report_new_emails(self, n_messages):
+        mailbox = self.server.mailbox
+        with mailbox.changed:
+            mailbox.changed.wait_for(lambda: len(mailbox.inbox) > n_messages or not self._idling)
+            if self._idling:
+                self.write(f"* {len(mailbox.inbox)} EXISTS")
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    The subset of ESMTP used by the server: EHLO/HELO, AUTH, MAIL, RCPT, DATA, RSET, NOOP and QUIT.
+    """
+    def write(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        sender, recipients = None, []
+        self.write("220 localhost Stand-in SMTP ready")
+
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb == "EHLO":
+                self.write("250-localhost")
+                self.write("250-8BITMIME")
+                self.write("250 AUTH PLAIN LOGIN")
+            elif verb == "HELO":
+                self.write("250 localhost")
+            elif verb == "AUTH":
+                self.write("235 Authentication successful")
+            elif verb == "MAIL":
+                _, sender = parseaddr(command.split(":", 1)[1])
+                recipients = []
+                self.write("250 OK")
+            elif verb == "RCPT":
+                recipients.append(parseaddr(command.split(":", 1)[1])[1])
+                self.write("250 OK")
+            elif verb == "DATA":
+                self.write("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                mailbox.receive(sender=sender, recipients=recipients, data=b"".join(data))
+                self.write("250 OK Message accepted")
+            elif verb in ("RSET", "NOOP"):
+                sender, recipients = (None, []) if verb == "RSET" else (sender, recipients)
+                self.write("250 OK")
+            elif verb == "QUIT":
+                self.write("221 Bye")
+                return
+            else:
+                self.write("502 Command not implemented")
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MailStandIns:
+    """
+    Local IMAP and SMTP servers (plain-text, any login accepted) sharing one Mailbox.
+    Used as context-manager, serving on free ports of localhost in background threads:
+        with MailStandIns() as stand_ins:
+            stand_ins.mailbox.deliver(sender="student@university.com", subject="20, X=1")
+    """
+    def __init__(self, host="127.0.0.1"):
+        self.mailbox = Mailbox()
+        self.imap = _ThreadingServer((host, 0), _IMAPHandler)
+        self.smtp = _ThreadingServer((host, 0), _SMTPHandler)
+        for server in (self.imap, self.smtp):
+            server.mailbox = self.mailbox
+        self.host = host
+        self._threads = []
+
+    @property
+    def imap_port(self):
+        return self.imap.server_address[1]
+
+    @property
+    def smtp_port(self):
+        return self.smtp.server_address[1]
+
+    def start(self):
+        for server in (self.imap, self.smtp):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        for server in (self.imap, self.smtp):
+            server.shutdown()
+            server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,222 @@
+import mailbox
+import re
+import shelve
+from email import policy
+from email.parser import BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
+
+import numpy as np
+import pandas as pd
+
+from project.define_server import ServerSettings, server_systems
+from project.src.allow_list import normalize_email
+from project.src.handled_emails import EmailLog, HandledIds, migrate_shelf
+from project.src.server_machinery import Server
+from project.src.server_stats import StatsDatabase
+from project.src.server_util import Storage
+from project.src.system_registry import ServedSystem
+
+# Errors of bad emails (the server only catches the first two, the others would have stopped it)
+_bad_email_errors = (ValueError, AttributeError, SyntaxError, TypeError)
+
+# Columns of the emails- and guesses-tables of the statistics database
+_email_columns = ["message_id", "time", "sender", "subject", "message", "success", "experiment", "n_samples", "guess",
+                  "incorrect_guess"]
+_guess_columns = ["message_id", "time", "sender", "shd", "n_missing", "n_extra", "n_reversed"]
+
+
+def mbox_log(path):
+    """
+    Log of emails in mbox-archive (message_id, time, subject, sender).
+    Message-ids are the IMAP UIDs in the X-UID header if the archive has them, otherwise the position in the archive.
+    Headers are parsed like in Server.parse_headers (so encoded subjects are decoded).
+    """
+    def parse_headers(file):
+        return BytesParser(policy=policy.default).parse(file, headersonly=True)
+
+    rows = []
+    for nr, message in enumerate(mailbox.mbox(str(path), factory=parse_headers, create=False), 1):
+        uid = str(message.get("X-UID", ""))
+        try:
+            time = parsedate_to_datetime(str(message.get("Date", ""))).timestamp()
+        except (TypeError, ValueError):
+            time = 0.
+        _, sender = parseaddr(str(message.get("From", "")))
+        rows.append((int(uid) if uid and uid.strip().isdigit() else nr, time, str(message.get("Subject", "")), sender))
+    return pd.DataFrame(rows, columns=["message_id", "time", "subject", "sender"])
+
+
+def store_log():
+    """
+    Log of emails in the persistent memory of the server (message_id, time, subject, sender).
+    Times come from the statistics databases (0 if unknown).
+    """
+    with shelve.open(str(Storage.shelf_path), flag="r") as db:
+        emails = db.get("emails", None)
+    if emails is None:
+        with EmailLog(Storage.email_log_path) as email_log:
+            emails = email_log.to_dict()
+
+    times = dict()
+    for name in server_systems:
+        if ServedSystem.stats_path(name=name).exists():
+            with StatsDatabase(ServedSystem.stats_path(name=name)) as stats:
+                times.update(stats.emails_time())
+
+    return pd.DataFrame(
+        [(message_id, times.get(message_id, 0.), email["subject"], email["sender"])
+         for message_id, email in emails.items()],
+        columns=["message_id", "time", "subject", "sender"],
+    )
+
+
+class _GuessChecker:
+    # Differences of graph-guesses to the true graphs, checked once per system and guess
+    def __init__(self):
+        self.systems = dict()
+        self.results = dict()
+
+    def __call__(self, system_name, guess):
+        key = (system_name, guess)
+        if key not in self.results:
+            if system_name not in self.systems:
+                self.systems[system_name] = server_systems[system_name]()
+                _ = self.systems[system_name].sample(1)
+            try:
+                self.results[key] = self.systems[system_name].graph_diff(edge_list=guess)
+            except _bad_email_errors as error:
+                self.results[key] = error
+        if isinstance(self.results[key], Exception):
+            raise self.results[key]
+        return self.results[key]
+
+
+def classify_emails(log, allowed_emails=None):
+    """
+    Handles each email of log like Server.handle_allowed_email, except that experiments are not sampled, as only the
+    number of samples is needed. Emails are sorted by message-id and senders not in allowed_emails are dropped.
+    Returns data-frame with the columns of the emails- and guesses-tables of the statistics database and the system
+    of each email.
+    """
+    log = log.sort_values("message_id", kind="stable").drop_duplicates("message_id")
+    log = log.assign(sender=log["sender"].map(normalize_email))
+    if allowed_emails is not None:
+        log = log[[sender in allowed_emails for sender in log["sender"]]]
+    check_guess = _GuessChecker()
+
+    rows = []
+    for message_id, time, subject, sender in log.itertuples(index=False):
+        system_name, query = server_systems.route(subject=subject, sender=sender)
+        experiment = guess = incorrect_guess = False
+        n_samples = 0
+        guess_diff = None
+
+        try:
+            # Guess of causal graph
+            if re.search("^\\s*guess:(.*)", query.lower()):
+                error_message = "Could not check graph for correctness"
+                guess_diff = check_guess(system_name=system_name, guess=Server.parse_guess(query=query))
+                guess, incorrect_guess = True, not guess_diff["correct"]
+
+            # Experiment
+            else:
+                error_message = "Cannot parse subject line"
+                n_samples, settings_str = Server.parse_experiment(query=query)
+                error_message = "Cannot extract settings"
+                Server.parse_settings(settings_str=settings_str)
+                experiment = True
+
+            error_message = "SUCCESS"
+            success = True
+        except _bad_email_errors:
+            n_samples = 0
+            success = False
+
+        diff_counts = (None,) * 4 if guess_diff is None else (
+            guess_diff["shd"], len(guess_diff["missing"]), len(guess_diff["extra"]), len(guess_diff["reversed"])
+        )
+        rows.append((message_id, time, sender, subject, error_message, success, experiment, n_samples, guess,
+                     incorrect_guess, system_name, *diff_counts))
+
+    return pd.DataFrame(rows, columns=_email_columns + ["system"] + _guess_columns[3:])
+
+
+def aggregate_users(emails):
+    """
+    Per-user totals of classified emails of one system, including the counts when the user first guessed correctly.
+    Returns data-frame with the columns of the users-table of the statistics database.
+    """
+    counts = pd.DataFrame(dict(
+        sender=emails["sender"].to_numpy(),
+        n_emails=np.ones(len(emails), dtype=int),
+        n_samples=emails["n_samples"].to_numpy(dtype=int),
+        n_experiments=emails["experiment"].to_numpy(dtype=int),
+        guesses=emails["guess"].to_numpy(dtype=int),
+        incorrect_guesses=emails["incorrect_guess"].to_numpy(dtype=int),
+    ))
+    users = counts.groupby("sender", sort=True).sum()
+
+    # Running totals at first correct guess
+    running = counts.groupby("sender")[["n_experiments", "n_samples", "incorrect_guesses"]].cumsum()
+    correct = (emails["guess"] & ~emails["incorrect_guess"]).to_numpy()
+    first_correct = running[correct].assign(
+        sender=counts["sender"][correct], done_time=emails["time"].to_numpy()[correct],
+    )
+    first_correct = first_correct.groupby("sender").first()
+    done = first_correct.rename(columns=dict(
+        n_experiments="done_experiments", n_samples="done_samples", incorrect_guesses="done_incorrect_guesses",
+    ))
+    users = users.join(done[["done_experiments", "done_samples", "done_incorrect_guesses", "done_time"]])
+
+    return users.reset_index()
+
+
+def users_dictionary(users):
+    # User-dictionary of the shelf
+    users_dict = dict()
+    for row in users.itertuples(index=False):
+        user_info = dict(
+            n_emails=int(row.n_emails),
+            n_experiments=int(row.n_experiments),
+            n_samples=int(row.n_samples),
+            guesses=int(row.guesses),
+            incorrect_guesses=int(row.incorrect_guesses),
+        )
+        if not pd.isna(row.done_experiments):
+            user_info["done"] = (int(row.done_experiments), int(row.done_samples), int(row.done_incorrect_guesses))
+        users_dict[row.sender] = user_info
+    return users_dict
+
+
+def replay(log, allowed_emails=None):
+    """
+    Rebuilds the persistent memory of the server (handled ids, emails, users and statistics databases) from a log of
+    emails, without sampling or connecting to the email provider.
+    Returns the classified emails.
+    """
+    emails = classify_emails(log=log, allowed_emails=allowed_emails)
+
+    handled_ids = HandledIds(Storage.handled_ids_path, max_journal=ServerSettings.handled_ids_journal)
+    with EmailLog(Storage.email_log_path) as email_log, shelve.open(str(Storage.shelf_path)) as db:
+        migrate_shelf(db=db, handled_ids=handled_ids, email_log=email_log)
+        email_log.clear()
+        email_log.add_many(emails={
+            row.message_id: dict(message=row.message, subject=row.subject, sender=row.sender, success=row.success)
+            for row in emails.itertuples(index=False)
+        })
+        handled_ids.write(ids=emails["message_id"], success_ids=emails["message_id"][emails["success"]])
+
+        for name in server_systems:
+            system_emails = emails[emails["system"] == name]
+            users = aggregate_users(system_emails)
+            db[ServedSystem.users_key(name=name)] = users_dictionary(users)
+            with StatsDatabase(ServedSystem.stats_path(name=name)) as stats:
+                stats.rebuild(
+                    emails=system_emails[_email_columns],
+                    users=users,
+                    guesses=system_emails.loc[system_emails["shd"].notna(), _guess_columns].astype(
+                        {key: int for key in _guess_columns[3:]}
+                    ),
+                )
+
+    return emails
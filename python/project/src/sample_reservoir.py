@@ -0,0 +1,105 @@
+import threading
+from collections import deque
+from time import perf_counter
+
+import pandas as pd
+
+
+def reservoir_key(system_name, settings):
+    # Settings as hashable key (columns are lists)
+    return system_name, tuple(sorted((key, tuple(val) if isinstance(val, list) else val)
+                                     for key, val in settings.items()))
+
+
+class SampleReservoir:
+    """
+    Pre-sampled rows of causal systems for common settings, so requests can be answered without sampling.
+    Each configuration (system and settings) has a queue of tables, which is refilled when the server is idle.
+    Requests take rows from the front of the queue, so rows are never sent twice. Requests for more rows than are
+    available are not answered from the reservoir. The memory of all reservoirs is bounded by max_bytes.
+    The reservoir can be used from multiple threads.
+    """
+    def __init__(self, configurations, rows_per_configuration, chunk_rows, max_bytes):
+        self.configurations = {reservoir_key(system_name, settings): (system_name, settings)
+                               for system_name, settings in configurations}
+        self.rows_per_configuration = rows_per_configuration
+        self.chunk_rows = chunk_rows
+        self.max_bytes = max_bytes
+
+        self._chunks = {key: deque() for key in self.configurations}
+        self._rows = {key: 0 for key in self.configurations}
+        self._row_bytes = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.configurations)
+
+    @property
+    def n_bytes(self):
+        return sum(self._rows[key] * self._row_bytes.get(key, 0) for key in self.configurations)
+
+    def take(self, system_name, settings, n_samples):
+        """
+        Table of n_samples fresh rows for the settings, or None if the reservoir does not have enough rows.
+        """
+        key = reservoir_key(system_name, settings)
+        with self._lock:
+            if self._rows.get(key, 0) < n_samples or n_samples <= 0:
+                return None
+
+            # Take rows from the front
+            chunks, n_missing = [], n_samples
+            while n_missing > 0:
+                chunk = self._chunks[key].popleft()
+                if len(chunk) > n_missing:
+                    self._chunks[key].appendleft(chunk.iloc[n_missing:])
+                    chunk = chunk.iloc[:n_missing]
+                chunks.append(chunk)
+                n_missing -= len(chunk)
+            self._rows[key] -= n_samples
+
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0].reset_index(drop=True)
+
+    def refill(self, sample, seconds):
+        """
+        Samples chunks for the least filled configurations for up to seconds (unless full).
+        sample(system_name, n_samples, settings) makes a table. Configurations where sampling fails are removed.
+        Returns the number of rows added.
+        """
+        deadline = perf_counter() + seconds
+        n_added = 0
+        while perf_counter() < deadline:
+
+            # Least filled configuration
+            with self._lock:
+                missing = {key: self.rows_per_configuration - self._rows[key] for key in self.configurations}
+                key = max(missing, key=missing.get, default=None)
+                if key is None or missing[key] <= 0:
+                    break
+                n_rows = min(self.chunk_rows, missing[key])
+                if self.n_bytes + n_rows * self._row_bytes.get(key, 0) > self.max_bytes:
+                    break
+                system_name, settings = self.configurations[key]
+
+            # Sample
+            try:
+                chunk = sample(system_name, n_rows, settings)
+            except (ValueError, AttributeError):
+                with self._lock:
+                    del self.configurations[key], self._chunks[key], self._rows[key]
+                continue
+
+            with self._lock:
+                self._chunks[key].append(chunk)
+                self._rows[key] += len(chunk)
+                self._row_bytes[key] = chunk.memory_usage(index=False).sum() / max(len(chunk), 1)
+            n_added += len(chunk)
+
+        return n_added
+
+    def fill_levels(self):
+        """
+        Dictionary from (system-name, settings) to the fraction of rows available.
+        """
+        with self._lock:
+            return {key: self._rows[key] / self.rows_per_configuration for key in self.configurations}
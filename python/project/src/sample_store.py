@@ -0,0 +1,133 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class SampleStore:
+    """
+    Binary store of the samples sent to students.
+    Each request is stored as a .npy-file, which can be memory-mapped, so re-sends and analyses can slice the data
+    without copying or parsing text. Samples with one type are stored as a 2d-array and samples with mixed types
+    (eg. int8 and float) as a structured array with one field per column. A SQLite index maps message ids to files,
+    columns and senders.
+    The store can be used from multiple threads.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Index
+        self.connection = sqlite3.connect(str(Path(self.path, "index.sqlite")), timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    message_id INTEGER PRIMARY KEY,
+                    time REAL NOT NULL,
+                    system TEXT,
+                    sender TEXT,
+                    columns TEXT NOT NULL,
+                    n_samples INTEGER NOT NULL,
+                    file_name TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS samples_time ON samples (time)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS samples_sender ON samples (sender)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __contains__(self, message_id):
+        return self.connection.execute(
+            "SELECT 1 FROM samples WHERE message_id = ?", (int(message_id),)
+        ).fetchone() is not None
+
+    def put(self, message_id, samples, sender=None, system=None, time=None):
+        time = datetime.now().timestamp() if time is None else time
+        file_name = f"{int(message_id)}.npy"
+
+        # Write data before index, so the index never points to missing data
+        if samples.dtypes.nunique() <= 1:
+            data = np.ascontiguousarray(samples.values)
+        else:
+            data = samples.to_records(index=False, column_dtypes=dict(samples.dtypes))
+        np.save(str(Path(self.path, file_name)), data, allow_pickle=False)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (int(message_id), time, system, sender, json.dumps(list(samples.columns)), samples.shape[0],
+                 file_name),
+            )
+
+    def get(self, message_id, mmap=True):
+        """
+        Samples of a request as a data-frame. With mmap the data is memory-mapped (read-only) instead of read.
+        """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT columns, file_name FROM samples WHERE message_id = ?", (int(message_id),)
+            ).fetchone()
+        if row is None:
+            raise KeyError(message_id)
+        columns, file_name = row
+
+        data = np.load(str(Path(self.path, file_name)), mmap_mode="r" if mmap else None, allow_pickle=False)
+        if data.dtype.names is not None:
+            data = {name: data[name] for name in data.dtype.names}
+        return pd.DataFrame(data=data, columns=json.loads(columns), copy=False)
+
+    def index(self, sender=None, since=None, until=None):
+        conditions, parameters = [], []
+        if sender is not None:
+            conditions.append("sender = ?")
+            parameters.append(sender)
+        if since is not None:
+            conditions.append("time >= ?")
+            parameters.append(since.timestamp())
+        if until is not None:
+            conditions.append("time < ?")
+            parameters.append(until.timestamp())
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        return pd.read_sql_query(
+            f"SELECT message_id, time, system, sender, n_samples FROM samples {where} ORDER BY message_id",
+            self.connection, params=parameters, index_col="message_id",
+        )
+
+    def compact(self, older_than):
+        """
+        Delete samples stored before the time older_than (eg. from previous terms) and files missing from the index.
+        Returns the number of deleted files and bytes.
+        """
+        n_files, n_bytes = 0, 0
+
+        # Remove old entries from index before deleting files
+        with self.connection:
+            file_names = {val for val, in self.connection.execute(
+                "SELECT file_name FROM samples WHERE time < ?", (older_than.timestamp(),)
+            )}
+            self.connection.execute("DELETE FROM samples WHERE time < ?", (older_than.timestamp(),))
+        indexed = {val for val, in self.connection.execute("SELECT file_name FROM samples")}
+
+        # Delete old and orphaned files (orphans only when old, as the server writes files before indexing them)
+        for path in self.path.glob("*.npy"):
+            is_orphan = path.name not in indexed and path.stat().st_mtime < older_than.timestamp()
+            if path.name in file_names or is_orphan:
+                n_bytes += path.stat().st_size
+                n_files += 1
+                path.unlink()
+
+        # Shrink index
+        self.connection.execute("VACUUM")
+
+        return n_files, n_bytes
@@ -0,0 +1,87 @@
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter
+
+import pandas as pd
+
+# Name used for the time of a sample-call not spent in structural equations (making the table etc.)
+other_name = "(other)"
+
+
+class SamplingProfiler:
+    """
+    Per-node statistics of CausalSystem.sample() across calls.
+    The time of a node is the time from the previous node was set until the node is set, which is the time of
+    evaluating its structural equation (self["node"] = ...). Reads count how often a node is used by other nodes.
+    With memory=True the peak memory allocated while evaluating each equation is traced with tracemalloc (slow).
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.bytes = defaultdict(int)
+        self.reads = defaultdict(int)
+        self.n_samples = 0
+        self._clock = None
+        self._started_tracing = False
+
+    def reset(self):
+        self.__init__(memory=self.memory)
+
+    def start_sample(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start_equation()
+
+    def _start_equation(self):
+        if self.memory:
+            tracemalloc.reset_peak()
+            self._memory_start = tracemalloc.get_traced_memory()[0]
+        self._clock = perf_counter()
+
+    def read(self, key):
+        self.reads[key] += 1
+
+    def set(self, key):
+        self.seconds[key] += perf_counter() - self._clock
+        self.calls[key] += 1
+        if self.memory:
+            self.bytes[key] += tracemalloc.get_traced_memory()[1] - self._memory_start
+        self._start_equation()
+
+    def end_sample(self, n_samples):
+        self.set(other_name)
+        self.n_samples += n_samples
+        self._clock = None
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def table(self):
+        """
+        Data-frame with calls, total and mean time, bytes allocated and reads of each node (slowest first).
+        """
+        nodes = list(self.calls)
+        table = pd.DataFrame(dict(
+            calls=[self.calls[key] for key in nodes],
+            seconds=[self.seconds[key] for key in nodes],
+            bytes=[self.bytes[key] for key in nodes],
+            reads=[self.reads[key] for key in nodes],
+        ), index=pd.Index(nodes, name="node"))
+        table.insert(2, "mean_ms", table["seconds"] / table["calls"] * 1000)
+        table.insert(3, "share", table["seconds"] / table["seconds"].sum())
+        if not self.memory:
+            table = table.drop(columns=["bytes"])
+        return table.sort_values("seconds", ascending=False)
+
+    def write_flamegraph(self, path, root="sample"):
+        """
+        Writes time of nodes in collapsed-stack format ("root;node microseconds" per line), which can be read by
+        flamegraph.pl, speedscope and similar tools.
+        """
+        lines = [f"{root};{key} {round(val * 1e6)}" for key, val in self.seconds.items()]
+        Path(path).write_text("\n".join(lines) + "\n")
@@ -2,270 +2,607 @@ import re
 import shelve
 import textwrap
 from ast import literal_eval
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email import policy
+from email.parser import BytesParser
+from email.utils import parseaddr
 from pathlib import Path
-from time import sleep
 
 from imapclient import IMAPClient, exceptions
-from project.define_server import ServerSettings, ExperimentSystem
-from project.src.server_util import Storage, slugify, pandas_print, send_mail
+from project.define_server import ServerSettings, server_systems
+from project.src.allow_list import AllowList, normalize_email
+from project.src.handled_emails import EmailLog, HandledIds, migrate_shelf
+from project.src.job_queue import JobQueue
+from project.src.mail_scheduler import MailScheduler
+from project.src.sample_reservoir import SampleReservoir
+from project.src.sample_store import SampleStore
+from project.src.server_util import Storage, send_mail, write_table
+from project.src.student_data import Janitor, user_directory
+from project.src.system_registry import ServedSystem, default_system
+
+# Only fetch the headers needed (without marking emails as read)
+_header_fetch = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM)]"
+
+
+class EmailJob:
+    """
+    An email being handled, with the results of the steps of handling it.
+    The steps (Server.start_email, check_guess_email, parse_query, ready_samples, store_samples, render_samples,
+    queue_data_reply, email_succeeded / email_failed and finish_email) are shared by Server.handle_allowed_email and
+    AsyncServer.handle_allowed_email_async, which runs the blocking steps on its thread pool.
+    """
+    def __init__(self, subject, sender, message_id, system_name, query, system, stage):
+        self.subject = subject
+        self.sender = sender
+        self.message_id = message_id
+        self.system_name = system_name
+        self.query = query
+        self.system = system
+        self.stage = stage
+        self.is_guess = re.search("^\\s*guess:(.*)", query.lower()) is not None
+
+        # Results
+        self.error_message = None
+        self.email_is_success = False
+        self.samples = None
+        self.files = None
+        self.graph_is_correct = None
+        self.guess_diff = None
+        self.ran_experiment = False
 
 
 class Server:
     def __init__(self):
         self.answer_emails = True
 
+        # Connection to the inbox (kept open between checks, see imap_inbox())
+        self._imap = None  # type: IMAPClient
+
         # Handle emails with access
-        self.allowed_emails = {val.strip() for val in ServerSettings.allowed_emails.split("\n") if val.strip()}
+        self.allowed_emails = AllowList(emails=ServerSettings.allowed_emails, path=ServerSettings.allowed_emails_file,
+                                        report=lambda text: self.print(f"\t\t{text}"))
 
-        # Make causal system
-        self.causal_system = ExperimentSystem()
+        # Ids of previously handled emails (memory-mapped snapshot) and log of emails (only read when needed)
+        self.prev_ids = HandledIds(Storage.handled_ids_path, max_journal=ServerSettings.handled_ids_journal)
+        self.email_log = EmailLog(Storage.email_log_path)
 
-        # Connect to shelf and get ids of previously handled emails
+        # Connect to shelf
         with shelve.open(str(Storage.shelf_path)) as db:
-            if "ids" in db:
-                self.prev_ids = db["ids"]
-                self.success_ids = db["success_ids"]
-                self.emails = db["emails"]
-                self.users = db["users"]
-            else:
-                self.prev_ids = set()
-                self.success_ids = set()
-                self.emails = dict()
-                self.users = dict()
-            db["allowed_emails"] = self.allowed_emails
+            migrate_shelf(db=db, handled_ids=self.prev_ids, email_log=self.email_log)
+            db["allowed_emails"] = set(self.allowed_emails)
+
+            # Make causal systems (each with their own users, statistics and leaderboard)
+            self.systems = {
+                name: ServedSystem(name=name, system_class=system_class, users=db.get(ServedSystem.users_key(name), {}))
+                for name, system_class in server_systems.items()
+            }
+
+            # Database of user statistics (filled from shelf if server was started before the database existed)
+            for name, system in self.systems.items():
+                if system.stats.is_empty and system.users:
+                    system.stats.import_shelf(emails=self.email_log.to_dict() if name == default_system else dict(),
+                                              users=system.users)
+
+        # Binary store of sent samples
+        self.sample_store = SampleStore(Storage.samples_path)
+
+        # Pre-sampled rows for common settings
+        self.reservoir = SampleReservoir(
+            configurations=[self.parse_reservoir_settings(val) for val in ServerSettings.reservoir_settings],
+            rows_per_configuration=ServerSettings.reservoir_rows,
+            chunk_rows=ServerSettings.reservoir_chunk_rows,
+            max_bytes=ServerSettings.reservoir_max_bytes,
+        )
+
+        # Threads for writing data-files
+        self.render_pool = ThreadPoolExecutor(max_workers=ServerSettings.render_workers)
+
+        # Stages of emails being handled (for resuming after a crash)
+        self.jobs = JobQueue(Storage.jobs_path)
+
+        # Queue of replies (sent by priority within the sending limits of the email provider)
+        self.outbox = MailScheduler(
+            send=self.send_reply,
+            done=self.reply_done,
+            rate=ServerSettings.smtp_rate,
+            burst=ServerSettings.smtp_burst,
+            coalesce_seconds=ServerSettings.error_coalesce_seconds,
+            retry_seconds=ServerSettings.smtp_retry_seconds,
+            max_attempts=ServerSettings.smtp_max_attempts,
+            report=lambda text: self.print(f"\t\t{text}"),
+        )
+
+        # Background deletion of old student data
+        self.janitor = Janitor(
+            interval=ServerSettings.data_cleanup_interval,
+            max_requests=ServerSettings.data_max_requests_per_user,
+            max_bytes=ServerSettings.data_max_bytes_per_user,
+            max_age_days=ServerSettings.data_max_age_days,
+            report=lambda metrics: self.print(
+                f"\t\tStudent data: {metrics['n_files']} files ({metrics['n_bytes'] / 1e6:.1f}MB) "
+                f"of {metrics['n_users']} users, {metrics['n_deleted_files']} files deleted "
+                f"({metrics['n_deleted_bytes'] / 1e6:.1f}MB), cleanup took {metrics['last_run_seconds']:.2f}s"
+            ),
+        )
 
     def print(self, *args, **kwargs):
         print(datetime.now().strftime("%Y-%m-%d %H:%M:%S"), end=" -> ")
         print(*args, **kwargs)
 
+    @staticmethod
+    def imap_client():
+        return IMAPClient(host=ServerSettings.imap_host, port=ServerSettings.imap_port, ssl=ServerSettings.imap_ssl)
+
+    def imap_inbox(self):
+        """
+        Logged-in connection with the inbox selected, which is opened once and used for checking and marking emails.
+        """
+        if self._imap is None:
+            client = self.imap_client()
+            try:
+                client.login(username=ServerSettings.username, password=ServerSettings.server_password)
+                client.select_folder("inbox")
+            except (exceptions.IMAPClientError, OSError):
+                client.shutdown()
+                raise
+            self._imap = client
+        return self._imap
+
+    def close_imap(self):
+        # Logs out (the connection is opened again when next needed, eg. after errors)
+        client, self._imap = self._imap, None
+        if client is not None:
+            try:
+                client.logout()
+            except (exceptions.IMAPClientError, OSError):
+                client.shutdown()
+
+    def search_criteria(self):
+        # Only emails not flagged as handled, unless rebuilding from the entire inbox
+        criteria = ['NOT', 'DELETED']
+        if self.answer_emails and ServerSettings.handled_email_action == "flag":
+            criteria += ['UNKEYWORD', ServerSettings.handled_email_keyword]
+        return criteria
+
     def get_emails(self):
+        """
+        Fetches subject and sender of new emails in batches of ServerSettings.imap_fetch_chunk.
+        Returns dictionary from message-id to (subject, sender) and the list of new message-ids.
+        """
         self.print("Checking emails")
 
-        # Log into mail
+        # Log into mail (if not already)
         response = None
         messages = None
         try:
-            with IMAPClient(host=ServerSettings.imap_host) as client:
-                client.login(username=ServerSettings.username, password=ServerSettings.server_password)
-                client.select_folder("inbox")
+            client = self.imap_inbox()
+
+            # Get messages
+            messages = client.search(self.search_criteria())
+
+            # Filter out previous emails
+            messages = [val for val in messages if val not in self.prev_ids]
+
+            # Fetch headers
+            response = dict()
+            chunk = ServerSettings.imap_fetch_chunk
+            for start in range(0, len(messages), chunk):
+                fetched = client.fetch(messages=messages[start:start + chunk], data=[_header_fetch])
+                for message_id, message_data in fetched.items():
+                    headers = next(val for key, val in message_data.items() if key.startswith(b"BODY[HEADER"))
+                    response[message_id] = self.parse_headers(headers)
+        except (exceptions.IMAPClientError, OSError):
+            self.close_imap()
+            response = None
 
-                # Get messages
-                messages = client.search(['NOT', 'DELETED'])
+        return response, messages
 
-                # Filter out previous emails
-                messages = [val for val in messages if val not in self.prev_ids]
+    def mark_handled_emails(self, messages):
+        """
+        Flags handled emails with ServerSettings.handled_email_keyword or moves them to
+        ServerSettings.handled_email_folder (one command per batch), so they are not searched again.
+        """
+        action = ServerSettings.handled_email_action
+        if not messages or action is None:
+            return
 
-                # Fetch envelopes
-                response = client.fetch(messages=messages, data='ENVELOPE')
-        except exceptions.IMAPClientError:
-            pass
+        try:
+            client = self.imap_inbox()
+            chunk = ServerSettings.imap_fetch_chunk
+
+            # Flag with keyword
+            if action == "flag":
+                for start in range(0, len(messages), chunk):
+                    client.add_flags(messages[start:start + chunk], [ServerSettings.handled_email_keyword])
+
+            # Move to folder
+            elif action == "move":
+                folder = ServerSettings.handled_email_folder
+                if not client.folder_exists(folder):
+                    client.create_folder(folder)
+                for start in range(0, len(messages), chunk):
+                    if client.has_capability("MOVE"):
+                        client.move(messages[start:start + chunk], folder)
+                    else:
+                        client.copy(messages[start:start + chunk], folder)
+                        client.delete_messages(messages[start:start + chunk])
+                if not client.has_capability("MOVE"):
+                    client.expunge()
+        except (exceptions.IMAPClientError, OSError):
+            self.close_imap()
+            self.print("\t\tCould not mark handled emails.")
 
-        return response, messages
+    @staticmethod
+    def rank_text(system, sender):
+        leaderboard = system.leaderboard
+
+        # Rank if already finished
+        if sender in leaderboard:
+            rank = leaderboard.rank(sender)
+            n_users = len(leaderboard)
+
+        # Rank user gets by finishing now
+        else:
+            user_info = system.users.get(sender, dict())
+            done = tuple(user_info.get(key, 0) for key in ("n_experiments", "n_samples", "incorrect_guesses"))
+            rank = leaderboard.rank_of_cost(cost=leaderboard.cost(done=done))
+            n_users = len(leaderboard) + 1
+
+        return f"You are number {rank} of {n_users} on the leaderboard."
 
     @staticmethod
-    def parse_envelope(envelope):
+    def parse_headers(headers):
+        message = BytesParser(policy=policy.default).parsebytes(headers, headersonly=True)
+
         # Get subject
-        try:
-            subject = envelope.subject.decode()
-        except AttributeError:
-            subject = ""
+        subject = str(message.get("Subject", ""))
 
-        # Get sender
-        sender = envelope.sender[0]
-        sender = sender.mailbox.decode() + "@" + sender.host.decode()
+        # Get sender (normalized, so name+tag@host is the same user as name@host)
+        _, sender = parseaddr(str(message.get("From", "")))
+        sender = normalize_email(sender)
 
         # Return
         return subject, sender
 
-    def handle_allowed_email(self, subject: str, sender: str, message_id):
-        error_message = None
-        samples = None
-        graph_is_correct = None
-        ran_experiment = False
-
-        # Catch most errors due to bad email
-        try:
-            # Check for guess of causal graph
-            search = re.search("^\\s*guess:(.*)", subject.lower())
-            if search:
-                error_message = "Could not check graph for correctness"
+    def send_reply(self, send_to, subject, text, files=None, message_ids=()):
+        # The message-ids (IMAP UIDs) of the answered emails are in the header X-Reply-To-Ids
+        send_mail(
+            send_from=ServerSettings.username,
+            send_to=send_to,
+            subject=subject,
+            text=text,
+            username=ServerSettings.username,
+            password=ServerSettings.server_password,
+            files=files,
+            email_smtp_server=ServerSettings.smtp_host,
+            email_smtp_port=ServerSettings.smtp_port,
+            starttls=ServerSettings.smtp_starttls,
+            headers={"X-Reply-To-Ids": ", ".join(map(str, message_ids))} if message_ids else None,
+        )
 
-                # Get graph-guess very precisely
-                guess = re.search("^[^{}()\\[\\]]*([\\[({].*[\\]})])[^{}()\\[\\]]*$", subject).group(1)
+    def queue_reply(self, message_id, kind, send_to, subject, text, files=None):
+        """
+        Queues reply to email (kind is "guess", "data" or "error"). The job of the email reaches the "sent" stage when
+        the reply is sent.
+        """
+        self.outbox.submit(
+            message_id=message_id, kind=kind, send_to=send_to, subject=subject, text=text, files=files,
+            n_bytes=sum(Path(val).stat().st_size for val in files or []),
+        )
 
-                # Un-escape strings
-                guess = guess.replace(r"\'", "'").replace(r'\"', '"')
+    def reply_done(self, message_id, sent):
+        if sent:
+            self.jobs.set_stage(message_id=message_id, stage="sent")
+        else:
+            self.print(f"\t\tCould not send reply to email {message_id}")
 
-                # Ensure causal system has been sampled
-                _ = self.causal_system.sample(1)
+        # Email is completely handled if it is also stored
+        if message_id in self.prev_ids:
+            self.jobs.finish(message_id=message_id)
 
-                # Check correctness
-                graph_is_correct = self.causal_system.check_correct_graph(edge_list=guess)
+    @staticmethod
+    def parse_guess(query):
+        # Get graph-guess very precisely
+        guess = re.search("^[^{}()\\[\\]]*([\\[({].*[\\]})])[^{}()\\[\\]]*$", query).group(1)
+
+        # Un-escape strings
+        return guess.replace(r"\'", "'").replace(r'\"', '"')
+
+    def check_guess(self, system, sender, guess):
+        # Ensure causal system has been sampled
+        _ = system.causal_system.sample(1)
+
+        # Check correctness
+        guess_diff = system.causal_system.graph_diff(edge_list=guess)
+        graph_is_correct = guess_diff["correct"]
+
+        # Information for email
+        if graph_is_correct:
+            subject_line = "CORRECT GRAPH!"
+            text = f"The following graph is CORRECT: \n{guess}"
+            if ServerSettings.reply_with_rank:
+                text += f"\n\n{self.rank_text(system=system, sender=sender)}"
+        else:
+            subject_line = "Incorrect graph."
+            text = f"The following graph is INCORRECT: \n{guess}"
+            text += self.guess_feedback_text(guess_diff=guess_diff)
+
+        return graph_is_correct, guess_diff, subject_line, text
 
-                # Information for email
-                if graph_is_correct:
-                    subject_line = "CORRECT GRAPH!"
-                    text = f"The following graph is CORRECT: \n{guess}"
-                else:
-                    subject_line = "Incorrect graph."
-                    text = f"The following graph is INCORRECT: \n{guess}"
+    @staticmethod
+    def guess_feedback_text(guess_diff):
+        feedback = ServerSettings.guess_feedback
+        if feedback not in ("shd", "edges"):
+            return ""
 
-                # Send email
-                if self.answer_emails:
-                    error_message = "Could not send email with guess-answer"
-                    send_mail(
-                        send_from=ServerSettings.username,
-                        send_to=sender,
-                        subject=subject_line,
-                        text=text,
-                        username=ServerSettings.username,
-                        password=ServerSettings.server_password,
-                        email_smtp_server=ServerSettings.smtp_host,
-                        email_smtp_port=ServerSettings.smtp_port,
-                    )
+        # Distance
+        text = f"\n\nStructural Hamming distance: {guess_diff['shd']} (edges to add, remove or reverse)"
 
-            # User wants samples
-            else:
+        # Differences
+        if feedback == "edges":
+            for key, name in (("missing", "Missing edges"), ("extra", "Extra edges"), ("reversed", "Reversed edges")):
+                if guess_diff[key]:
+                    text += f"\n{name}: {guess_diff[key]}"
 
-                # Parse subject line
-                error_message = "Cannot parse subject line"
-                search = re.search("^(\\d+)[ ,\\s]*([^\n]*)", subject)
-                n_samples = int(search.group(1))
-                settings_str = str(search.group(2)).strip()
-
-                # Evaluate settings
-                error_message = "Cannot extract settings"
-                settings = dict()
-                settings_parts = re.findall("([_\\w]+)=([\\d.\\w]+)", settings_str)
-                for key, value in settings_parts:
-                    if key == "password":
-                        settings[key] = str(value)
-                    else:
-                        settings[key] = literal_eval(value)
+        return text
 
-                # Make samples
-                error_message = "Could not make samples"
-                samples = self.causal_system.sample(n_samples, **settings)
+    @staticmethod
+    def parse_experiment(query):
+        search = re.search("^(\\d+)[ ,\\s]*([^\n]*)", query)
+        n_samples = int(search.group(1))
+        settings_str = str(search.group(2)).strip()
+        return n_samples, settings_str
 
-                #####
-                # Send response
+    @staticmethod
+    def parse_settings(settings_str):
+        settings = dict()
+
+        # Requested columns (like "cols=X,G")
+        search = re.search("cols\\s*=\\s*([_\\w]+(?:\\s*,\\s*[_\\w]+\\b(?!\\s*=))*)", settings_str)
+        if search:
+            settings["cols"] = [val.strip() for val in search.group(1).split(",")]
+            settings_str = settings_str[:search.start()] + settings_str[search.end():]
+
+        settings_parts = re.findall("([_\\w]+)=([\\d.\\w]+)", settings_str)
+        for key, value in settings_parts:
+            if key == "password":
+                settings[key] = str(value)
+            else:
+                settings[key] = literal_eval(value)
+        return settings
+
+    def parse_reservoir_settings(self, settings_str):
+        system_name, query = server_systems.route(subject=settings_str, sender="")
+        return system_name, self.parse_settings(settings_str=query)
+
+    def refill_reservoir(self, seconds):
+        """
+        Samples rows for the reservoir for up to seconds and reports its fill level.
+        """
+        if not len(self.reservoir):
+            return
+        n_added = self.reservoir.refill(
+            sample=lambda name, n_samples, settings: self.systems[name].causal_system.sample(n_samples, **settings),
+            seconds=seconds,
+        )
+        if n_added:
+            levels = self.reservoir.fill_levels()
+            self.print(f"\t\tSample reservoir: {n_added} rows added, {len(levels)} settings "
+                       f"{100 * sum(levels.values()) / max(len(levels), 1):.0f}% full "
+                       f"({self.reservoir.n_bytes / 1e6:.1f}MB)")
+
+    def stored_samples(self, message_id, stage):
+        # Samples made before a restart (so resumed emails get the same samples)
+        if JobQueue.reached(stage, "sampled") and message_id in self.sample_store:
+            return self.sample_store.get(message_id=message_id, mmap=False)
+        return None
+
+    def write_data_files(self, sender, message_id, samples):
+        # Directory for specific user
+        directory = user_directory(sender=sender)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        # File path
+        file_path = Path(directory, f"data_{message_id}.csv")
+        file_path_readable = Path(directory, f"data_{message_id}_readable.txt")
+        files = [file_path, file_path_readable]
+
+        # Files are written under temporary names and renamed when done, so existing files are complete
+        if all(path.exists() for path in files):
+            return files
+
+        # Write files in parallel
+        futures = [
+            self.render_pool.submit(self._write_data_file, file_path, samples),
+            self.render_pool.submit(self._write_readable_data_file, file_path_readable, samples),
+        ]
+        for future in futures:
+            future.result()
+
+        return files
 
-                if self.answer_emails:
+    @staticmethod
+    def _write_data_file(file_path, samples):
+        # Make data-file (written in chunks of rows)
+        temporary_path = file_path.with_name(file_path.name + ".tmp")
+        with temporary_path.open("w") as file:
+            samples.to_csv(
+                path_or_buf=file, sep=",", header=True, index=True, chunksize=ServerSettings.render_chunk_rows,
+            )
+        temporary_path.replace(file_path)
 
-                    error_message = "Path problems"
-
-                    # Directory for specific user
-                    user_directory = Path(Storage.data_path, slugify(sender.replace("@", "_at_")))
-                    user_directory.mkdir(parents=True, exist_ok=True)
-
-                    # File path
-                    file_path = Path(user_directory, f"data_{message_id}.csv")
-                    file_path_readable = Path(user_directory, f"data_{message_id}_readable.txt")
-                    assert not file_path.exists()
-                    assert not file_path_readable.exists()
-
-                    # Make data-file
-                    with file_path.open("w") as file:
-                        samples.to_csv(
-                            path_or_buf=file, sep=",", header=True, index=True,
-                        )
-
-                    # Make human readable data-file
-                    with pandas_print():
-                        with file_path_readable.open("w") as file:
-                            file.write(samples.__repr__())
-
-                    # Send email
-                    error_message = "Could not send email with samples"
-                    line = f"Data for query: {subject}"
-                    send_mail(
-                        send_from=ServerSettings.username,
-                        send_to=sender,
-                        subject=line,
-                        text=line,
-                        username=ServerSettings.username,
-                        password=ServerSettings.server_password,
-                        files=[file_path, file_path_readable],
-                        email_smtp_server=ServerSettings.smtp_host,
-                        email_smtp_port=ServerSettings.smtp_port,
-                    )
+    @staticmethod
+    def _write_readable_data_file(file_path, samples):
+        # Make human readable data-file (written in chunks of rows)
+        temporary_path = file_path.with_name(file_path.name + ".tmp")
+        with temporary_path.open("w") as file:
+            write_table(file=file, table=samples, chunk_rows=ServerSettings.render_chunk_rows)
+        temporary_path.replace(file_path)
+
+    error_text = textwrap.dedent("""
+    Example of experiment query: 
+        20, X=1
+    
+    Example of experiment query only returning some columns:
+        20, X=1, cols=Y,Z
+    
+    Example of guess query:
+        guess: [('A', 'B'), ('B', 'C')]
+    
+    """)
+
+    def print_handled(self, message_id, email_is_success, error_message, subject, sender):
+        if email_is_success:
+            self.print(f"\t\tEmail {message_id}: {error_message}, [{subject}], [{sender}]")
+        elif sender is not None:
+            self.print(f"\t\tEmail {message_id}: {error_message}, [{subject}], {'[' + str(sender) + ']':50s}<--")
+        else:
+            self.print(f"\t\tEmail {message_id}: {error_message} {'[-]':50s}<--")
+
+    def start_email(self, subject, sender, message_id):
+        """
+        Registers email and returns the job with its causal system and the stage reached before a restart.
+        """
+        system_name, query = server_systems.route(subject=subject, sender=sender)
+        return EmailJob(
+            subject=subject, sender=sender, message_id=message_id, system_name=system_name, query=query,
+            system=self.systems[system_name],
+            stage=self.jobs.start(message_id=message_id, subject=subject, sender=sender),
+        )
 
-                # This was an experiment
-                ran_experiment = True
+    def answers(self, job):
+        # Whether the reply to the email has to be sent
+        return self.answer_emails and not JobQueue.reached(job.stage, "sent")
 
-            # Success
-            error_message = "SUCCESS"
-            email_is_success = True
-            self.print(f"\t\tEmail {message_id}: {error_message}, [{subject}], [{sender}]")
+    def check_guess_email(self, job):
+        job.error_message = "Could not check graph for correctness"
 
-        # Bad email
-        except (ValueError, AttributeError):
-            email_is_success = False
-            if sender is not None:
-                self.print(f"\t\tEmail {message_id}: {error_message}, [{subject}], {'[' + str(sender) + ']':50s}<--")
-            else:
-                self.print(f"\t\tEmail {message_id}: {error_message} {'[-]':50s}<--")
-
-            # Send answer and this time ignore all errors
-            if self.answer_emails:
-                try:
-                    subject_line = f"Unknown query: {subject}"
-                    text = textwrap.dedent("""
-                    Example of experiment query: 
-                        20, X=1
-                    
-                    Example of guess query:
-                        guess: [('A', 'B'), ('B', 'C')]
-                    
-                    """)
-                    send_mail(
-                        send_from=ServerSettings.username,
-                        send_to=sender,
-                        subject=subject_line,
-                        text=text,
-                        username=ServerSettings.username,
-                        password=ServerSettings.server_password,
-                        email_smtp_server=ServerSettings.smtp_host,
-                        email_smtp_port=ServerSettings.smtp_port,
-                    )
-                except (ValueError, AttributeError):
-                    pass
+        # Check guess
+        guess = self.parse_guess(query=job.query)
+        job.graph_is_correct, job.guess_diff, subject_line, text = self.check_guess(
+            system=job.system, sender=job.sender, guess=guess,
+        )
 
+        # Send email
+        if self.answers(job):
+            self.queue_reply(message_id=job.message_id, kind="guess", send_to=job.sender, subject=subject_line,
+                             text=text)
+
+    def parse_query(self, job):
+        """
+        Number of samples and settings of the experiment of the email.
+        """
+        # Parse subject line
+        job.error_message = "Cannot parse subject line"
+        n_samples, settings_str = self.parse_experiment(query=job.query)
+
+        # Evaluate settings
+        job.error_message = "Cannot extract settings"
+        settings = self.parse_settings(settings_str=settings_str)
+
+        job.error_message = "Could not make samples"
+        return n_samples, settings
+
+    def ready_samples(self, job, n_samples, settings):
+        """
+        Samples that do not have to be sampled (stored before a restart or pre-sampled in the reservoir), or None.
+        """
+        samples = self.stored_samples(message_id=job.message_id, stage=job.stage)
+        if samples is None:
+            samples = self.reservoir.take(system_name=job.system_name, settings=settings, n_samples=n_samples)
+        return samples
+
+    def store_samples(self, job):
+        if not JobQueue.reached(job.stage, "sampled"):
+            self.sample_store.put(message_id=job.message_id, samples=job.samples, sender=job.sender,
+                                  system=job.system_name)
+            self.jobs.set_stage(message_id=job.message_id, stage="sampled")
+
+    def render_samples(self, job):
+        job.error_message = "Path problems"
+        job.files = self.write_data_files(sender=job.sender, message_id=job.message_id, samples=job.samples)
+        self.jobs.set_stage(message_id=job.message_id, stage="rendered")
+
+    def queue_data_reply(self, job):
+        line = f"Data for query: {job.subject}"
+        self.queue_reply(message_id=job.message_id, kind="data", send_to=job.sender, subject=line, text=line,
+                         files=job.files)
+
+    def email_succeeded(self, job):
+        job.error_message = "SUCCESS"
+        job.email_is_success = True
+        self.print_handled(job.message_id, job.email_is_success, job.error_message, job.subject, job.sender)
+
+    def email_failed(self, job):
+        job.email_is_success = False
+        self.print_handled(job.message_id, job.email_is_success, job.error_message, job.subject, job.sender)
+
+        # Send answer (repeated errors of a student are answered in one email)
+        if self.answers(job):
+            self.queue_reply(message_id=job.message_id, kind="error", send_to=job.sender,
+                             subject=f"Unknown query: {job.subject}", text=self.error_text)
+
+    def finish_email(self, job):
         # Update storage
         self.update_persistent_memory(
-            message_id=message_id,
-            email_is_success=email_is_success,
-            error_message=error_message,
-            subject=subject,
-            sender=sender,
-            samples=samples,
-            graph_is_correct=graph_is_correct,
-            ran_experiment=ran_experiment,
+            system=job.system,
+            message_id=job.message_id,
+            email_is_success=job.email_is_success,
+            error_message=job.error_message,
+            subject=job.subject,
+            sender=job.sender,
+            samples=job.samples,
+            graph_is_correct=job.graph_is_correct,
+            ran_experiment=job.ran_experiment,
+            guess_diff=job.guess_diff,
         )
+        return job.email_is_success, job.error_message
 
-        # Return
-        return email_is_success, error_message
+    def handle_allowed_email(self, subject: str, sender: str, message_id):
+        job = self.start_email(subject=subject, sender=sender, message_id=message_id)
 
-    def update_persistent_memory(self, message_id, email_is_success, error_message, subject, sender,
-                                 samples, graph_is_correct, ran_experiment):
-        # Handle email-id
-        self.prev_ids.add(message_id)
+        # Catch most errors due to bad email
+        try:
+            # Guess of causal graph
+            if job.is_guess:
+                self.check_guess_email(job)
 
-        # Handle success
-        if email_is_success:
-            self.success_ids.add(message_id)
+            # User wants samples
+            else:
+                n_samples, settings = self.parse_query(job)
+                job.samples = self.ready_samples(job, n_samples=n_samples, settings=settings)
+                if job.samples is None:
+                    job.samples = job.system.causal_system.sample(n_samples, **settings)
 
-        # Handle email data
-        self.emails[message_id] = dict(
-            message=error_message,
-            subject=subject,
-            sender=sender,
-            success=email_is_success,
-        )
+                # Send response
+                if self.answers(job):
+                    self.store_samples(job)
+                    self.render_samples(job)
+                    self.queue_data_reply(job)
+
+                # This was an experiment
+                job.ran_experiment = True
+
+            self.email_succeeded(job)
+
+        # Bad email
+        except (ValueError, AttributeError):
+            self.email_failed(job)
 
-        # Handle user emails
-        user_info = self.users.get(sender, dict())
+        return self.finish_email(job)
+
+    def update_persistent_memory(self, system, message_id, email_is_success, error_message, subject, sender,
+                                 samples, graph_is_correct, ran_experiment, guess_diff=None):
+        # Already stored (server stopped before job was finished)
+        if message_id in self.prev_ids:
+            if message_id not in self.outbox:
+                self.jobs.finish(message_id=message_id)
+            return
+
+        # Handle user emails (time is also the finish time on the leaderboard)
+        time = datetime.now().timestamp()
+        user_info = system.users.get(sender, dict())
         user_info["n_emails"] = user_info.get("n_emails", 0) + 1
 
         # Handle user experiments
@@ -274,7 +611,7 @@ class Server:
         # Handle user samples
         if samples is not None:
             user_info["n_samples"] = user_info.get("n_samples", 0) + samples.shape[0]
-        self.users[sender] = user_info
+        system.users[sender] = user_info
 
         # Handle user guesses
         if graph_is_correct is not None:
@@ -283,22 +620,80 @@ class Server:
 
             # Check for correct guess - finish student
             if graph_is_correct and "done" not in user_info:
-                user_info["done"] = (user_info["n_experiments"], user_info["n_samples"], user_info["incorrect_guesses"])
+                user_info["done"] = (user_info["n_experiments"], user_info.get("n_samples", 0),
+                                     user_info["incorrect_guesses"])
+                system.leaderboard.add(user=sender, done=user_info["done"], time=time)
 
-        # Store persistently
+        # Update statistics database
+        system.stats.record_email(
+            message_id=message_id,
+            sender=sender,
+            subject=subject,
+            message=error_message,
+            success=email_is_success,
+            n_samples=0 if samples is None else samples.shape[0],
+            ran_experiment=ran_experiment,
+            graph_is_correct=graph_is_correct,
+            done=user_info.get("done", None),
+            time=time,
+            guess_diff=guess_diff,
+        )
+
+        # Store email and users persistently
+        self.email_log.add(
+            message_id=message_id,
+            message=error_message,
+            subject=subject,
+            sender=sender,
+            success=email_is_success,
+        )
         with shelve.open(str(Storage.shelf_path)) as db:
-            db["ids"] = self.prev_ids
-            db["emails"] = self.emails
-            db["users"] = self.users
-            db["success_ids"] = self.success_ids
+            db[ServedSystem.users_key(system.name)] = system.users
+
+        # Handle email-id (last, so email is handled again if the server stops before this)
+        self.prev_ids.add(message_id, success=email_is_success)
+
+        # Email is completely handled (unless its reply is still queued)
+        if message_id not in self.outbox:
+            self.jobs.finish(message_id=message_id)
+
+    def resume_jobs(self):
+        """
+        Finishes emails that were being handled when the server stopped.
+        """
+        for message_id, subject, sender, stage in self.jobs.unfinished():
+            sender = normalize_email(sender)
+
+            # Reply is still queued
+            if message_id in self.outbox:
+                continue
+
+            # Stored emails are only handled again if their reply was not sent
+            self.print(f"\t\tResuming email {message_id} from stage: {stage}")
+            stored = message_id in self.prev_ids and (JobQueue.reached(stage, "sent") or not self.answer_emails)
+            if stored or sender not in self.allowed_emails:
+                self.jobs.finish(message_id=message_id)
+            else:
+                self.handle_allowed_email(subject=subject, sender=sender, message_id=message_id)
 
     def __call__(self, answer_emails=True, single_run=False):
         self.answer_emails = answer_emails
 
+        # Start deleting old student data
+        if not single_run and not self.janitor.is_alive():
+            self.janitor.start()
+
+        # Finish emails from before a restart
+        self.resume_jobs()
+
         # Keep reading emails
         while True:
             print("")
 
+            # Reload allowed emails if file has changed
+            if self.allowed_emails.refresh():
+                self.print(f"\t\tReloaded allowed emails ({len(self.allowed_emails)} emails).")
+
             # Get emails
             response, messages = self.get_emails()
 
@@ -313,10 +708,7 @@ class Server:
             else:
 
                 # Go through messages
-                for message_id, message_data in response.items():
-
-                    # Parse envelope
-                    subject, sender = self.parse_envelope(envelope=message_data[b"ENVELOPE"])
+                for message_id, (subject, sender) in response.items():
 
                     # Check sender
                     if sender in self.allowed_emails:
@@ -328,10 +720,25 @@ class Server:
                         error_message = "Email address not allowed access."
                         self.print(f"\t\tEmail {message_id}: {error_message} {'[-]':50s}<--")
 
+                # Mark handled emails on server (emails of senders without access are checked again, as they may be
+                #   given access later)
+                if self.answer_emails:
+                    self.mark_handled_emails(messages=[val for val in response if val in self.prev_ids])
+
             #########################################
 
-            # Sleep a bit
+            # Send queued replies
+            self.outbox.send_due()
+            if len(self.outbox):
+                self.print(f"\t\t{len(self.outbox)} replies queued")
+
+            # Sleep a bit (refilling sample reservoir first and sending queued replies while sleeping)
             if single_run:
+                self.outbox.flush()
                 break
-            self.print(f"Sleeping {ServerSettings.check_email_delay}s")
-            sleep(ServerSettings.check_email_delay)
+            start = datetime.now()
+            refill_seconds = min(ServerSettings.reservoir_refill_seconds, ServerSettings.check_email_delay)
+            self.refill_reservoir(seconds=refill_seconds)
+            delay = max(0., ServerSettings.check_email_delay - (datetime.now() - start).total_seconds())
+            self.print(f"Sleeping {delay:.1f}s")
+            self.outbox.send_for(seconds=delay)
@@ -0,0 +1,239 @@
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+
+# Columns of per-user statistics
+user_columns = ["n_emails", "n_samples", "n_experiments", "guesses", "incorrect_guesses", "bad_emails"]
+
+
+class StatsDatabase:
+    """
+    Per-user statistics of the server stored in SQLite.
+    The server updates the tables incrementally for each handled email, so inspection can query the statistics
+    directly instead of recomputing them from the entire history.
+        emails: One row per handled email (used for time-window queries).
+        users: Running totals per user (used for the leaderboard and user table).
+        guesses: Distance to the true graph of each graph-guess (from CausalSystem.graph_diff).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(str(path), timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS emails (
+                    message_id INTEGER PRIMARY KEY,
+                    time REAL NOT NULL,
+                    sender TEXT,
+                    subject TEXT,
+                    message TEXT,
+                    success INTEGER NOT NULL,
+                    experiment INTEGER NOT NULL,
+                    n_samples INTEGER NOT NULL,
+                    guess INTEGER NOT NULL,
+                    incorrect_guess INTEGER NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS emails_time ON emails (time)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS emails_sender ON emails (sender, time)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    sender TEXT PRIMARY KEY,
+                    n_emails INTEGER NOT NULL DEFAULT 0,
+                    n_samples INTEGER NOT NULL DEFAULT 0,
+                    n_experiments INTEGER NOT NULL DEFAULT 0,
+                    guesses INTEGER NOT NULL DEFAULT 0,
+                    incorrect_guesses INTEGER NOT NULL DEFAULT 0,
+                    done_experiments INTEGER,
+                    done_samples INTEGER,
+                    done_incorrect_guesses INTEGER,
+                    done_time REAL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS guesses (
+                    message_id INTEGER PRIMARY KEY,
+                    time REAL NOT NULL,
+                    sender TEXT,
+                    shd INTEGER NOT NULL,
+                    n_missing INTEGER NOT NULL,
+                    n_extra INTEGER NOT NULL,
+                    n_reversed INTEGER NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS guesses_sender ON guesses (sender, time)")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def is_empty(self):
+        return self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+
+    def record_email(self, message_id, sender, subject, message, success, n_samples, ran_experiment,
+                     graph_is_correct, done=None, time=None, guess_diff=None):
+        time = datetime.now().timestamp() if time is None else time
+        guess = graph_is_correct is not None
+        incorrect_guess = guess and not graph_is_correct
+
+        with self.connection:
+            # Log email (ignore emails already recorded)
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO emails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(message_id), time, sender, subject, message, int(success), int(ran_experiment),
+                 int(n_samples), int(guess), int(incorrect_guess)),
+            )
+            if cursor.rowcount == 0:
+                return
+
+            # Update running totals of user
+            self.connection.execute("""
+                INSERT INTO users (sender, n_emails, n_samples, n_experiments, guesses, incorrect_guesses)
+                VALUES (?, 1, ?, ?, ?, ?)
+                ON CONFLICT (sender) DO UPDATE SET
+                    n_emails = n_emails + 1,
+                    n_samples = n_samples + excluded.n_samples,
+                    n_experiments = n_experiments + excluded.n_experiments,
+                    guesses = guesses + excluded.guesses,
+                    incorrect_guesses = incorrect_guesses + excluded.incorrect_guesses
+            """, (sender, int(n_samples), int(ran_experiment), int(guess), int(incorrect_guess)))
+
+            # Distance of guess to true graph
+            if guess_diff is not None:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO guesses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (int(message_id), time, sender, int(guess_diff["shd"]), len(guess_diff["missing"]),
+                     len(guess_diff["extra"]), len(guess_diff["reversed"])),
+                )
+
+            # User finished
+            if done is not None:
+                self._set_done(sender=sender, done=done, time=time)
+
+    def _set_done(self, sender, done, time):
+        self.connection.execute("""
+            UPDATE users SET done_experiments = ?, done_samples = ?, done_incorrect_guesses = ?, done_time = ?
+            WHERE sender = ? AND done_experiments IS NULL
+        """, (*[int(val) for val in done], time, sender))
+
+    def import_shelf(self, emails, users):
+        """
+        Fill tables from the email- and user-dictionaries of the shelf (for servers started before the database
+        existed). The time and contents of old emails are unknown, so they only count towards the running totals.
+        """
+        with self.connection:
+            for message_id, email in emails.items():
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO emails VALUES (?, 0, ?, ?, ?, ?, 0, 0, 0, 0)",
+                    (int(message_id), email["sender"], email["subject"], email["message"], int(email["success"])),
+                )
+            for sender, user_info in users.items():
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO users (sender, n_emails, n_samples, n_experiments, guesses, "
+                    "incorrect_guesses) VALUES (?, ?, ?, ?, ?, ?)",
+                    (sender, *[int(user_info.get(key, 0)) for key in user_columns[:-1]]),
+                )
+                if "done" in user_info:
+                    self._set_done(sender=sender, done=user_info["done"], time=None)
+
+    def rebuild(self, emails, users, guesses):
+        """
+        Replace tables with data-frames of emails, users and guesses (columns named as in the tables), in one
+        transaction.
+        """
+        with self.connection:
+            for name, table in (("emails", emails), ("users", users), ("guesses", guesses)):
+                self.connection.execute(f"DELETE FROM {name}")
+                table.to_sql(name, self.connection, if_exists="append", index=False)
+
+    def done_times(self):
+        # Time each finished user finished (if known)
+        return dict(self.connection.execute(
+            "SELECT sender, done_time FROM users WHERE done_time IS NOT NULL"
+        ).fetchall())
+
+    def emails_time(self):
+        # Time of each recorded email
+        return dict(self.connection.execute("SELECT message_id, time FROM emails").fetchall())
+
+    def n_emails(self, since=None, until=None):
+        where, parameters = self._where(since=since, until=until)
+        return self.connection.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(success), 0) FROM emails {where}", parameters
+        ).fetchone()
+
+    def user_table(self, since=None, until=None, user=None):
+        # Running totals
+        if since is None and until is None:
+            where, parameters = self._where(user=user)
+            query = f"""
+                SELECT sender, n_emails, n_samples, n_experiments, guesses, incorrect_guesses,
+                       n_emails - n_experiments - guesses AS bad_emails
+                FROM users {where}
+            """
+
+        # Aggregate emails in time-window
+        else:
+            where, parameters = self._where(since=since, until=until, user=user)
+            query = f"""
+                SELECT sender, COUNT(*) AS n_emails, SUM(n_samples) AS n_samples,
+                       SUM(experiment) AS n_experiments, SUM(guess) AS guesses,
+                       SUM(incorrect_guess) AS incorrect_guesses,
+                       COUNT(*) - SUM(experiment) - SUM(guess) AS bad_emails
+                FROM emails {where} GROUP BY sender
+            """
+
+        return pd.read_sql_query(query + " ORDER BY sender", self.connection, params=parameters, index_col="sender")
+
+    def competition_table(self, experiment_cost, sample_cost, incorrect_guess_cost, since=None, until=None,
+                          user=None):
+        where, parameters = self._where(since=since, until=until, user=user, time_column="done_time")
+        where = ("WHERE " if not where else where + " AND ") + "done_experiments IS NOT NULL"
+        query = f"""
+            SELECT sender, done_experiments AS n_experiments, done_samples AS n_samples,
+                   done_incorrect_guesses AS incorrect_guesses,
+                   done_experiments * ? + done_samples * ? + done_incorrect_guesses * ? AS cost
+            FROM users {where} ORDER BY cost, done_time
+        """
+        return pd.read_sql_query(query, self.connection, index_col="sender",
+                                 params=[experiment_cost, sample_cost, incorrect_guess_cost, *parameters])
+
+    def guess_table(self, since=None, until=None, user=None):
+        """
+        Graph-guesses of each user with the best, mean and last structural Hamming distance to the true graph.
+        """
+        where, parameters = self._where(since=since, until=until, user=user)
+        guesses = pd.read_sql_query(
+            f"SELECT sender, shd, n_missing, n_extra, n_reversed FROM guesses {where} ORDER BY message_id",
+            self.connection, params=parameters,
+        )
+        return guesses.groupby("sender").agg(
+            guesses=("shd", "size"),
+            best_shd=("shd", "min"),
+            mean_shd=("shd", "mean"),
+            last_shd=("shd", "last"),
+            last_missing=("n_missing", "last"),
+            last_extra=("n_extra", "last"),
+            last_reversed=("n_reversed", "last"),
+        )
+
+    @staticmethod
+    def _where(since=None, until=None, user=None, time_column="time"):
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append(f"{time_column} >= ?")
+            parameters.append(since.timestamp())
+        if until is not None:
+            conditions.append(f"{time_column} < ?")
+            parameters.append(until.timestamp())
+        if user is not None:
+            conditions.append("sender = ?")
+            parameters.append(user)
+        return ("WHERE " + " AND ".join(conditions)) if conditions else "", parameters
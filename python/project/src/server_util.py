@@ -1,58 +1,119 @@
+import base64
 import os
 import re
 import smtplib
 import unicodedata
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 
 import pandas as pd
 from os.path import basename
-from email.mime.application import MIMEApplication
+from email.generator import BytesGenerator
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.utils import COMMASPACE, formatdate
+from email.policy import compat32
+from email.utils import COMMASPACE, formatdate, make_msgid
 
+# Messages are spooled to disk when larger than this (bytes)
+spool_max_memory = 1024 * 1024
+
+# Attachments are base64-encoded in chunks of this many bytes (multiple of 57, which is one line of base64)
+_base64_chunk = 57 * 1024
+
+# Messages are sent to the SMTP server in blocks of this many bytes
+_smtp_block = 64 * 1024
+
+# SMTP uses CRLF line endings
+_smtp_policy = compat32.clone(linesep="\r\n")
 
-def send_mail(
-        send_from, send_to, subject, text,
-        username, password,
-        files=None,
-        email_smtp_server="smtp.gmail.com", email_smtp_port=587):
-    if isinstance(send_to, str):
-        send_to = [send_to]
-    assert isinstance(send_to, list)
 
-    # Make message
-    msg = MIMEMultipart()
+def _write_headers(file, message):
+    for name, value in message.items():
+        file.write(_smtp_policy.fold_binary(name, value))
+    file.write(b"\r\n")
+
+
+def write_mail(file, send_from, send_to, subject, text, files=None, headers=None):
+    """
+    Writes MIME-message to file. Attachments are read and base64-encoded in chunks, so they are never fully in memory.
+    headers is a dictionary of extra headers.
+    """
+    boundary = "=" * 15 + make_msgid().strip("<>").replace("@", "_") + "=="
+
+    # Headers of message
+    msg = MIMEMultipart(boundary=boundary)
     msg['From'] = send_from
     msg['To'] = COMMASPACE.join(send_to)
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = subject
+    for name, value in (headers or dict()).items():
+        msg[name] = value
+    _write_headers(file=file, message=msg)
 
     # Do text
-    msg.attach(MIMEText(text))
+    file.write(f"--{boundary}\r\n".encode())
+    BytesGenerator(file, policy=_smtp_policy).flatten(MIMEText(text))
+    file.write(b"\r\n")
 
     # Attach files
     for f in files or []:
-        with open(f, "rb") as fil:
-            part = MIMEApplication(
-                fil.read(),
-                Name=basename(f)
-            )
-        # After the file is closed
+        part = MIMEBase("application", "octet-stream", Name=basename(f))
+        part['Content-Transfer-Encoding'] = "base64"
         part['Content-Disposition'] = 'attachment; filename="%s"' % basename(f)
-        msg.attach(part)
+        file.write(f"--{boundary}\r\n".encode())
+        _write_headers(file=file, message=part)
+        with open(f, "rb") as fil:
+            for chunk in iter(lambda: fil.read(_base64_chunk), b""):
+                file.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
 
-    # Login
-    server = smtplib.SMTP(email_smtp_server, email_smtp_port)
-    server.ehlo()
-    server.starttls()
-    server.login(username, password)
+    file.write(f"--{boundary}--\r\n".encode())
 
-    # Send email
-    server.sendmail(send_from, send_to, msg.as_string())
 
-    # Log out
-    server.quit()
+def send_mail(
+        send_from, send_to, subject, text,
+        username, password,
+        files=None,
+        email_smtp_server="smtp.gmail.com", email_smtp_port=587, starttls=True, headers=None):
+    if isinstance(send_to, str):
+        send_to = [send_to]
+    assert isinstance(send_to, list)
+
+    with SpooledTemporaryFile(max_size=spool_max_memory) as message:
+
+        # Make message
+        write_mail(file=message, send_from=send_from, send_to=send_to, subject=subject, text=text, files=files,
+                   headers=headers)
+        message.seek(0)
+
+        # Login (the connection is closed when done, also after errors)
+        with smtplib.SMTP(email_smtp_server, email_smtp_port) as server:
+            server.ehlo()
+            if starttls:
+                server.starttls()
+            server.login(username, password)
+
+            # Send email (streamed in blocks instead of as one string)
+            server.mail(send_from)
+            for recipient in send_to:
+                code, response = server.rcpt(recipient)
+                if code not in (250, 251):
+                    raise smtplib.SMTPRecipientsRefused({recipient: (code, response)})
+            code, response = server.docmd("data")
+            if code != 354:
+                raise smtplib.SMTPDataError(code, response)
+            line_start = True
+            for block in iter(lambda: message.read(_smtp_block), b""):
+                # Lines starting with a period are escaped with another period
+                block = block.replace(b"\n.", b"\n..")
+                if line_start and block.startswith(b"."):
+                    block = b"." + block
+                line_start = block.endswith(b"\n")
+                server.send(block)
+            server.send(b".\r\n" if line_start else b"\r\n.\r\n")
+            code, response = server.getreply()
+            if code != 250:
+                raise smtplib.SMTPDataError(code, response)
 
 
 def slugify(value):
@@ -71,6 +132,35 @@ def pandas_print():
     return pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 300)
 
 
+def write_table(file, table, chunk_rows):
+    """
+    Writes table as text like table.to_string(), formatting chunk_rows rows at a time (pandas' display options are not
+    used, as they are global and changing them is not safe from several threads).
+    Columns are aligned over the entire table, but numbers are formatted within each chunk (eg. with exponents).
+    """
+    with SpooledTemporaryFile(max_size=spool_max_memory, mode="w+") as formatted:
+
+        # Format chunks (spooled, to align them when the widths of all columns are known)
+        index_width = 0
+        widths = [len(str(val)) + 1 for val in table.columns]
+        for start in range(0, len(table), chunk_rows):
+            chunk = table.iloc[start:start + chunk_rows]
+            index_width = max(index_width, max(len(str(val)) for val in chunk.index))
+            lines = chunk.to_string(index=False, header=False).split("\n")
+            for line in lines:
+                # Numbers have room for a sign like in to_string()
+                widths = [max(width, len(val) + (val[0] != "-")) for width, val in zip(widths, line.split())]
+            formatted.writelines(line + "\n" for line in lines)
+        formatted.seek(0)
+
+        # Write aligned
+        file.write(" " * index_width + "".join(f" {val:>{width}}" for val, width in zip(table.columns, widths)) + "\n")
+        file.writelines(
+            f"{str(label):<{index_width}}" + "".join(f" {val:>{width}}" for val, width in zip(line.split(), widths))
+            + "\n" for label, line in zip(table.index, formatted)
+        )
+
+
 class Storage:
     # Working directory
     _cwd = Path.cwd()
@@ -79,13 +169,39 @@ class Storage:
         _cwd = Path.cwd()
     assert Path.cwd().name == "project"
 
-    # Main path
-    main = Path(Path.cwd(), "storage")
+    @classmethod
+    def use(cls, main):
+        """
+        Sets all storage paths relative to main directory (the default is project/storage).
+        """
+        # Main path
+        cls.main = Path(main)
+
+        # Prepare path for internal storage shelf
+        cls.shelf_path = Path(cls.main, "_storage", "previous_emails")
+        cls.shelf_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Path (stem) of snapshot of ids of handled emails
+        cls.handled_ids_path = Path(cls.main, "_storage", "handled_ids")
+
+        # Path for log of handled emails
+        cls.email_log_path = Path(cls.main, "_storage", "emails.sqlite")
+
+        # Path for database of user statistics
+        cls.stats_path = Path(cls.main, "_storage", "stats.sqlite")
+
+        # Path for queue of emails being handled
+        cls.jobs_path = Path(cls.main, "_storage", "jobs.sqlite")
+
+        # Prepare path for student data
+        cls.data_path = Path(cls.main, "student_data")
+        cls.data_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Path for data being deleted in the background
+        cls.trash_path = Path(cls.main, "_trash")
+
+        # Path for binary store of samples
+        cls.samples_path = Path(cls.main, "sample_store")
 
-    # Prepare path for internal storage shelf
-    shelf_path = Path(main, "_storage", "previous_emails")
-    shelf_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Prepare path for student data
-    data_path = Path(main, "student_data")
-    data_path.parent.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+Storage.use(Path(Path.cwd(), "storage"))
@@ -0,0 +1,150 @@
+import hashlib
+import re
+import shutil
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from time import time
+
+from project.src.server_util import Storage, slugify
+
+
+def user_directory(sender):
+    """
+    Directory of data for user. Directories are sharded by a hash of the user, so no directory grows too large.
+    """
+    slug = slugify(sender.replace("@", "_at_"))
+    shard = hashlib.sha1(slug.encode()).hexdigest()[:2]
+    return Path(Storage.data_path, shard, slug)
+
+
+def user_directories():
+    for path in Storage.data_path.glob("*"):
+        if not path.is_dir():
+            continue
+
+        # Sharded directories
+        if re.fullmatch("[0-9a-f]{2}", path.name):
+            yield from (val for val in path.glob("*") if val.is_dir())
+
+        # Directories from before sharding
+        else:
+            yield path
+
+
+def move_to_trash(path):
+    """
+    Moves path to trash (fast rename), from where it can be deleted in the background.
+    """
+    Storage.trash_path.mkdir(parents=True, exist_ok=True)
+    trash = Path(Storage.trash_path, f"{path.name}_{datetime.now():%Y%m%d_%H%M%S_%f}")
+    path.rename(trash)
+    return trash
+
+
+def empty_trash():
+    n_bytes = 0
+    if Storage.trash_path.exists():
+        for path in Storage.trash_path.glob("*"):
+            n_bytes += sum(val.stat().st_size for val in path.rglob("*") if val.is_file())
+            shutil.rmtree(path, ignore_errors=True)
+    return n_bytes
+
+
+class Janitor(threading.Thread):
+    """
+    Background thread deleting old student data.
+    For each user the newest max_requests requests are kept, as long as they fit in max_bytes and are younger
+    than max_age_days (None means no limit). Also empties the trash.
+    The report-function is called with the metrics after each cleanup.
+    """
+    def __init__(self, interval=600, max_requests=None, max_bytes=None, max_age_days=None, report=None):
+        super().__init__(name="janitor", daemon=True)
+        self.interval = interval
+        self.report = report
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._stop_event = threading.Event()
+
+        # Metrics
+        self.metrics = dict(
+            n_runs=0,
+            n_users=0,
+            n_files=0,
+            n_bytes=0,
+            n_deleted_files=0,
+            n_deleted_bytes=0,
+            last_run_seconds=None,
+        )
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.clean()
+            if self.report is not None:
+                self.report(self.metrics)
+            self._stop_event.wait(self.interval)
+
+    def clean(self):
+        start = time()
+        n_users, n_files, n_bytes = 0, 0, 0
+        n_deleted_files, n_deleted_bytes = 0, 0
+
+        # Trash from resets
+        n_deleted_bytes += empty_trash()
+
+        # Retention of each user
+        for directory in user_directories():
+            n_users += 1
+
+            # Group files by request (data-file and readable data-file)
+            requests = defaultdict(list)
+            for path in directory.glob("*"):
+                search = re.search("^data_(\\d+)", path.name)
+                if path.is_file() and search:
+                    requests[int(search.group(1))].append((path, path.stat()))
+
+            # Newest first
+            requests = sorted(requests.values(), key=lambda files: -max(stat.st_mtime for _, stat in files))
+
+            # Keep within limits
+            user_bytes = 0
+            for nr, files in enumerate(requests):
+                request_bytes = sum(stat.st_size for _, stat in files)
+                user_bytes += request_bytes
+                if self._keep(nr=nr, user_bytes=user_bytes, files=files, now=start):
+                    n_files += len(files)
+                    n_bytes += request_bytes
+                else:
+                    for path, _ in files:
+                        path.unlink(missing_ok=True)
+                    n_deleted_files += len(files)
+                    n_deleted_bytes += request_bytes
+
+        # Update metrics
+        self.metrics.update(
+            n_runs=self.metrics["n_runs"] + 1,
+            n_users=n_users,
+            n_files=n_files,
+            n_bytes=n_bytes,
+            n_deleted_files=self.metrics["n_deleted_files"] + n_deleted_files,
+            n_deleted_bytes=self.metrics["n_deleted_bytes"] + n_deleted_bytes,
+            last_run_seconds=time() - start,
+        )
+
+        return n_deleted_files, n_deleted_bytes
+
+    def _keep(self, nr, user_bytes, files, now):
+        if self.max_requests is not None and nr >= self.max_requests:
+            return False
+        if self.max_bytes is not None and user_bytes > self.max_bytes:
+            return False
+        if self.max_age_days is not None:
+            age_days = (now - max(stat.st_mtime for _, stat in files)) / (24 * 60 * 60)
+            if age_days > self.max_age_days:
+                return False
+        return True
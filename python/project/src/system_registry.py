@@ -0,0 +1,83 @@
+import re
+from pathlib import Path
+
+from project.src.allow_list import parse_emails, normalize_email
+from project.src.leaderboard import Leaderboard
+from project.src.server_stats import StatsDatabase
+from project.src.server_util import Storage
+
+# Name of the system used for emails that are not routed elsewhere
+default_system = "default"
+
+
+class SystemRegistry:
+    """
+    Named causal systems served by one server.
+    Emails are routed to a system by a subject prefix (eg. "[name] 20, X=1") or by the sender being in the group of
+    the system. All other emails go to the default system.
+    """
+    def __init__(self):
+        self.systems = dict()
+        self.groups = dict()
+
+    def register(self, name, system_class, senders=""):
+        name = name.strip().lower()
+        self.systems[name] = system_class
+
+        # Senders using this system (same format as allowed emails)
+        for sender in parse_emails(senders):
+            self.groups[sender] = name
+
+        return system_class
+
+    def __getitem__(self, name):
+        return self.systems[name]
+
+    def __iter__(self):
+        return iter(self.systems)
+
+    def items(self):
+        return self.systems.items()
+
+    def route(self, subject, sender):
+        """
+        Returns name of system for email and the subject without the system prefix.
+        """
+        search = re.search("^\\s*\\[([^\\[\\]]+)]\\s*(.*)$", subject, flags=re.DOTALL)
+        if search and search.group(1).strip().lower() in self.systems:
+            return search.group(1).strip().lower(), search.group(2)
+        return self.groups.get(normalize_email(sender), default_system), subject
+
+
+class ServedSystem:
+    """
+    A causal system served by the server, with its own users, statistics and leaderboard.
+    """
+    def __init__(self, name, system_class, users):
+        self.name = name
+        self.system_class = system_class
+        self.causal_system = system_class()
+        self.users = users
+
+        # Database of user statistics
+        self.stats = StatsDatabase(self.stats_path(name=name))
+
+        # Competition leaderboard (ties are ordered by the finish times in the statistics)
+        self.leaderboard = Leaderboard.from_users(
+            users=users,
+            done_times=self.stats.done_times(),
+            experiment_cost=system_class.experiment_cost,
+            sample_cost=system_class.sample_cost,
+            incorrect_guess_cost=system_class.incorrect_guess_cost,
+        )
+
+    @staticmethod
+    def users_key(name):
+        # Key of users in shelf
+        return "users" if name == default_system else f"users_{name}"
+
+    @staticmethod
+    def stats_path(name):
+        if name == default_system:
+            return Storage.stats_path
+        return Path(Storage.stats_path.parent, f"stats_{name}.sqlite")
@@ -0,0 +1,113 @@
+"""
+Runs Server and AsyncServer on the same traffic against the local IMAP/SMTP stand-ins and checks that they handle the
+emails in the same way. Run with "python -m pytest project/tests" from the python directory.
+"""
+import contextlib
+import io
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from project.define_server import ServerSettings
+from project.src.mail_stand_ins import MailStandIns
+from project.src.server_util import Storage
+
+# Emails of two students (experiments, guesses and malformed subjects)
+students = ["student_1@university.com", "student_2@university.com"]
+traffic = [
+    (students[0], "20"),
+    (students[1], "10, X=1"),
+    (students[0], "hello"),
+    (students[0], "guess: [('X', 'G'), ('F', 'G')]"),
+    (students[1], "5, X=2, Y=0, cols=G,I"),
+    (students[1], "guess: [('X', 'G'), ('F', 'G'), ('F', 'I')]"),
+    (students[0], "30, F=0.5"),
+    (students[1], "X=1"),
+    (students[0], "guess: [('X', 'G'), ('F', 'G'), ('F', 'I')]"),
+    (students[1], "15"),
+]
+
+# Server settings pointing at the stand-ins (every email gets its own reply, without pacing)
+settings = dict(
+    imap_host="127.0.0.1", imap_ssl=False, smtp_host="127.0.0.1", smtp_starttls=False,
+    username="server@localhost", server_password="stand-in", allowed_emails="\n".join(students),
+    allowed_emails_file=None, handled_email_action="flag", check_email_delay=0.1, idle_timeout=1,
+    smtp_rate=None, error_coalesce_seconds=None, reservoir_settings=[],
+)
+
+
+def run_server(use_asyncio, timeout=120):
+    """
+    Handles traffic with a new server and returns its replies, users and rows of the statistics databases.
+    """
+    original_settings = {key: getattr(ServerSettings, key) for key in list(settings) + ["imap_port", "smtp_port"]}
+    original_main = Storage.main
+
+    with tempfile.TemporaryDirectory() as directory, MailStandIns() as stand_ins:
+        mailbox = stand_ins.mailbox
+        for key, val in settings.items():
+            setattr(ServerSettings, key, val)
+        ServerSettings.imap_port = stand_ins.imap_port
+        ServerSettings.smtp_port = stand_ins.smtp_port
+        Storage.use(Path(directory, "storage"))
+
+        try:
+            # Server (imported here, as it reads the settings)
+            if use_asyncio:
+                from project.src.async_server import AsyncServer
+                server = AsyncServer()
+            else:
+                from project.src.server_machinery import Server
+                server = Server()
+
+            # Handle emails
+            for sender, subject in traffic:
+                mailbox.deliver(sender=sender, subject=subject)
+            start = perf_counter()
+            while mailbox.n_sent() < len(traffic) and perf_counter() - start < timeout:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    server(single_run=True)
+            server.close_imap()
+
+            # Results (without times, which differ between runs)
+            replies = sorted((tuple(val["recipients"]), val["subject"], tuple(val["reply_to_ids"]))
+                             for val in mailbox.sent)
+            users = {name: dict(system.users) for name, system in server.systems.items()}
+            tables = dict()
+            for name, system in server.systems.items():
+                connection = system.stats.connection
+                tables[name] = dict(
+                    emails=connection.execute(
+                        "SELECT message_id, sender, subject, message, success, experiment, n_samples, guess, "
+                        "incorrect_guess FROM emails ORDER BY message_id"
+                    ).fetchall(),
+                    users=connection.execute(
+                        "SELECT sender, n_emails, n_samples, n_experiments, guesses, incorrect_guesses, "
+                        "done_experiments, done_samples, done_incorrect_guesses FROM users ORDER BY sender"
+                    ).fetchall(),
+                    guesses=connection.execute(
+                        "SELECT message_id, sender, shd, n_missing, n_extra, n_reversed FROM guesses "
+                        "ORDER BY message_id"
+                    ).fetchall(),
+                )
+                connection.close()
+        finally:
+            for key, val in original_settings.items():
+                setattr(ServerSettings, key, val)
+            Storage.use(original_main)
+
+    return replies, users, tables
+
+
+def test_server_modes_handle_emails_alike():
+    replies, users, tables = run_server(use_asyncio=False)
+    async_replies, async_users, async_tables = run_server(use_asyncio=True)
+
+    # Every email is answered
+    assert len(replies) == len(traffic)
+    assert sorted(uid for _, _, ids in replies for uid in ids) == list(range(1, len(traffic) + 1))
+
+    # Both servers send the same replies and keep the same statistics
+    assert async_replies == replies
+    assert async_users == users
+    assert async_tables == tables
@@ -5,44 +5,84 @@ _cause_probability = 0.5  # If this is not 0.5, then we need no intervention to
 _effect_probability = 0.65
 
 
-def sample_switch(n_samples, intervene_blue=None, intervene_purple=None):
+def sample_switch(n_samples, intervene_blue=None, intervene_purple=None, n_experiments=None, rng=None):
+    """
+    Samples the switches (columns are blue and purple).
+    Returns array of shape (n_samples, 2), or (n_experiments, n_samples, 2) for many independent experiments.
+    rng can be a np.random.Generator (default is the global numpy random state).
+    """
+    shape = (1 if n_experiments is None else n_experiments, n_samples)
+
+    # All randomness is drawn in one go
+    uniforms = _uniforms(shape=shape + (2,), rng=rng)
+
+    if "b" in _cause_is.lower():
+        data = _sample_switch(uniforms=uniforms, intervene_cause=intervene_blue, intervene_effect=intervene_purple)
+    elif "p" in _cause_is.lower():
+        data = _sample_switch(uniforms=uniforms, intervene_cause=intervene_purple, intervene_effect=intervene_blue)
+        data = data[..., ::-1]
+    else:
+        data = _sample_causes(uniforms=uniforms)
+
+    return data[0] if n_experiments is None else data
+
+
+def switch_probabilities(intervene_blue=None, intervene_purple=None):
+    """
+    Exact probabilities of the switches, as array where entry [blue, purple] is the probability of the combination.
+    """
+    cause_table = _cause_table(intervene=intervene_blue if "b" in _cause_is.lower() else intervene_purple)
+
     if "b" in _cause_is.lower():
-        return _sample_switch(n_samples=n_samples, intervene_cause=intervene_blue, intervene_effect=intervene_purple)
+        return _switch_table(cause_table=cause_table, intervene_effect=intervene_purple)
     elif "p" in _cause_is.lower():
-        return np.flip(
-            _sample_switch(n_samples=n_samples, intervene_cause=intervene_purple, intervene_effect=intervene_blue),
-            axis=1
-        )
-    return np.array([
-        _sample_cause(n_samples=n_samples),
-        _sample_cause(n_samples=n_samples)
-    ]).T
+        return _switch_table(cause_table=cause_table, intervene_effect=intervene_blue).T
+    return np.outer(_cause_table(intervene=intervene_blue), _cause_table(intervene=intervene_purple))
 
 
-def _sample_cause(n_samples: int):
-    return np.random.choice([1, 0], size=n_samples, replace=True, p=[_cause_probability, 1 - _cause_probability])
+def _uniforms(shape, rng=None):
+    if rng is None:
+        return np.random.random_sample(size=shape)
+    return rng.random(size=shape)
 
 
-def _sample_effect(causes: np.ndarray):
-    n_samples = causes.shape[0]
-    flips = np.random.choice([1, 0], size=n_samples, replace=True, p=[1 - _effect_probability, _effect_probability])
-    return causes * (1 - flips) + (1 - causes) * flips
+def _sample_causes(uniforms):
+    return (uniforms < _cause_probability).astype(int)
 
 
-def _sample_switch(n_samples, intervene_cause=None, intervene_effect=None):
+def _sample_switch(uniforms, intervene_cause=None, intervene_effect=None):
+    data = np.empty(uniforms.shape, dtype=int)
+
     # Cause
     if intervene_cause is not None:
-        causes = np.ones((n_samples,), dtype=np.int) * intervene_cause
+        data[..., 0] = intervene_cause
     else:
-        causes = _sample_cause(n_samples=n_samples)
+        data[..., 0] = uniforms[..., 0] < _cause_probability
 
-    # Effect
+    # Effect (follows the cause with probability _effect_probability)
     if intervene_effect is not None:
-        effects = np.ones((n_samples,), dtype=np.int) * intervene_effect
+        data[..., 1] = intervene_effect
     else:
-        effects = _sample_effect(causes=causes)
-
-    # Combined data
-    data = np.stack((causes, effects), axis=1)
+        np.not_equal(data[..., 0], uniforms[..., 1] >= _effect_probability, out=data[..., 1])
 
     return data
+
+
+def _cause_table(intervene=None):
+    if intervene is not None:
+        return np.array([1 - intervene, intervene], dtype=float)
+    return np.array([1 - _cause_probability, _cause_probability])
+
+
+def _switch_table(cause_table, intervene_effect=None):
+    # Table of effect given cause
+    if intervene_effect is not None:
+        effect_given_cause = np.tile(_cause_table(intervene=intervene_effect), (2, 1))
+    else:
+        effect_given_cause = np.array([
+            [_effect_probability, 1 - _effect_probability],
+            [1 - _effect_probability, _effect_probability],
+        ])
+
+    # Joint table of cause and effect
+    return cause_table[:, None] * effect_given_cause